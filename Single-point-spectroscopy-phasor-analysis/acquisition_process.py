@@ -0,0 +1,424 @@
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from histogram_store import HistogramSnapshot, HistogramStore
+from ingestion import MacroTimeBatcher, PhotonIngestor
+from metrics import Metrics, flatten
+from recorder import EventRecorder
+from slice_history import SLICE_SECONDS
+
+
+# float64 slots at the start of the shared block, before the histograms, sums and totals
+SEQUENCE, BASIS_VERSION, TOTAL_PHOTONS, PHOTONS_PER_SECOND = range(4)
+HEADER_SLOTS = 8
+
+
+class SharedHistogramStore:
+    """HistogramStore whose histograms, phasor sums and photon totals live in a
+    multiprocessing.shared_memory block, written by the acquisition process and
+    mapped without copies by the GUI process.
+
+    The writer guards every update with a sequence counter (odd while writing,
+    even once done). snapshot() copies the arrays and retries when the counter
+    was odd or moved during the copy, so it always returns a consistent state
+    and never blocks the writer. The snapshots have the same fields as the ones
+    of HistogramStore.
+
+    The sums are accumulated in the basis of the writer, identified by a
+    version number: set_basis on the GUI side gives the new basis a version and
+    queues it to the writer, and snapshots carry the basis object of the
+    version their sums were accumulated with.
+
+    With a Metrics registry the writer records the time the counter stays
+    odd for every chunk, i.e. how long readers may have to retry.
+    """
+
+    def __init__(self, names=('reference', 'data'), bins=256, basis=None, channels=1, max_harmonics=10,
+                 name=None, commands=None, metrics=None):
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.bins = bins
+        self.channels = channels
+        self.max_harmonics = max_harmonics
+        # the GUI creates the block, the acquisition process attaches to it by name
+        self.owner = name is None
+        shape = (len(self.names), channels)
+        sizes = (HEADER_SLOTS, np.prod(shape) * bins, np.prod(shape) * 2 * max_harmonics, np.prod(shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=int(sum(sizes)) * 8)
+        offsets = np.cumsum((0,) + sizes) * 8
+        buffer = self.shm.buf
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.float64, buffer=buffer, offset=offsets[0])
+        self._histograms = np.ndarray(shape + (bins,), dtype=np.float64, buffer=buffer, offset=offsets[1])
+        self._sums = np.ndarray(shape + (2 * max_harmonics,), dtype=np.float64, buffer=buffer, offset=offsets[2])
+        self._totals = np.ndarray(shape, dtype=np.float64, buffer=buffer, offset=offsets[3])
+        if self.owner:
+            self.header[:] = 0
+            self._histograms[:] = 0
+            self._sums[:] = 0
+            self._totals[:] = 0
+
+        self.commands = commands
+        self.metrics = metrics
+        self.basis = np.zeros((0, bins)) if basis is None else basis
+        self.basis_version = 0
+        # reader side: basis of the recent versions
+        self._bases = {0: self.basis}
+        # writer side: (version, basis) to accumulate with and the one the sums are in
+        self._pending = self._sums_in = (0, self.basis)
+        self._front = None
+
+    # name, names, bins, channels and max_harmonics: what the acquisition process needs to attach
+    def spec(self):
+        return self.shm.name, self.names, self.bins, self.channels, self.max_harmonics
+
+    @classmethod
+    def attach(cls, spec, basis, metrics=None):
+        name, names, bins, channels, max_harmonics = spec
+        return cls(names, bins, basis, channels, max_harmonics, name=name, metrics=metrics)
+
+    def close(self):
+        self._histograms = self._sums = self._totals = self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # GUI side: the basis gets the next version and is queued to the writer, which
+    # picks it up on its next chunk; the writer passes the version it received
+    def set_basis(self, basis, version=None):
+        if version is not None:
+            self._pending = (version, basis)
+            return
+        if basis is self.basis:
+            return
+        if basis.shape[0] > 2 * self.max_harmonics:
+            raise ValueError(f'at most {self.max_harmonics} harmonics fit in the shared phasor sums')
+        self.basis_version += 1
+        self.basis = basis
+        self._bases[self.basis_version] = basis
+        self._bases.pop(self.basis_version - 8, None)
+        if self.commands is not None:
+            self.commands.put(('basis', self.basis_version, basis))
+
+    def basis_of(self, version):
+        return self._bases.get(version)
+
+    # writer side (acquisition process only); counts: (channels, bins)
+    def add(self, name, counts):
+        i = self.index[name]
+        pending = self._pending
+        version, basis = pending
+        rows = basis.shape[0]
+        header = self.header
+        start = time.perf_counter()
+        header[SEQUENCE] += 1
+        if pending is not self._sums_in:
+            # harmonics or laser frequency changed: rebuild the running sums once from the histograms
+            self._sums[..., :rows] = self._histograms @ basis.T
+            self._sums_in = pending
+            header[BASIS_VERSION] = version
+        self._histograms[i] += counts
+        self._sums[i, :, :rows] += counts @ basis.T
+        self._totals[i] += counts.sum(axis=-1)
+        header[SEQUENCE] += 1
+        if self.metrics is not None:
+            self.metrics.observe('publish', time.perf_counter() - start)
+
+    # writer side: the state after the last add (the writer never races with itself) and
+    # the basis version of its sums; the reader maps the version back to its basis
+    def writer_snapshot(self):
+        version, basis = self._sums_in
+        snapshot = self._snapshot(int(self.header[SEQUENCE]) // 2, self._histograms.copy(),
+                                  self._sums[..., :basis.shape[0]].copy(), self._totals.copy(), None)
+        return snapshot, version
+
+    def set_rates(self, total_photons, photons_per_second):
+        self.header[TOTAL_PHOTONS] = total_photons
+        self.header[PHOTONS_PER_SECOND] = photons_per_second
+
+    @property
+    def photons_per_second(self):
+        return float(self.header[PHOTONS_PER_SECOND])
+
+    @property
+    def total_photons(self):
+        return int(self.header[TOTAL_PHOTONS])
+
+    def _snapshot(self, sequence, histograms, sums, totals, basis):
+        histograms.flags.writeable = False
+        return HistogramSnapshot(
+            sequence,
+            {name: histograms[i] for name, i in self.index.items()},
+            {name: sums[i] for name, i in self.index.items()},
+            {name: totals[i] for name, i in self.index.items()},
+            basis,
+        )
+
+    # reader side: a consistent copy of the shared arrays, the same object while nothing changed
+    def snapshot(self):
+        header = self.header
+        while True:
+            sequence = header[SEQUENCE]
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            if self._front is not None and self._front.sequence == sequence // 2:
+                return self._front
+            version = int(header[BASIS_VERSION])
+            histograms = self._histograms.copy()
+            sums = self._sums.copy()
+            totals = self._totals.copy()
+            if header[SEQUENCE] == sequence:
+                break
+        basis = self.basis_of(version)
+        sums = sums[..., :0 if basis is None else basis.shape[0]]
+        self._front = self._snapshot(int(sequence) // 2, histograms, sums, totals, basis)
+        return self._front
+
+    phasor_sums = staticmethod(HistogramStore.phasor_sums)
+
+
+class AcquisitionWorker:
+    """Acquisition, ingestion and accumulation running in the acquisition process.
+
+    Photons from the API are folded by a PhotonIngestor into the shared
+    histograms; data batches are cut on the macro times like in the GUI and
+    the snapshot at every boundary is sent back on the event queue, followed by
+    a 'stopped' event once an acquisition is stopped. The counts of every
+    SLICE_SECONDS slice of the data acquisitions are sent back too, for the
+    GUI's SliceHistory. The ingestion metrics of the process are sent back
+    once per second.
+    """
+
+    def __init__(self, spec, basis, bin_offset, channels, batch_seconds, simulate, events, overflow='block',
+                 counter_is_index=False):
+        self.events = events
+        self.metrics = Metrics()
+        self.metrics_interval = 1.0
+        self.histograms = SharedHistogramStore.attach(spec, basis, self.metrics)
+        events.put(('attached', spec[0]))
+        bins = self.histograms.bins
+        self.ingestor = PhotonIngestor(self.receive_chunk, bins=bins, bin_offset=bin_offset, chunk_size=65536,
+                                       flush_interval=0.05, channels=channels, metrics=self.metrics,
+                                       overflow=overflow, counter_is_index=counter_is_index)
+        if simulate:
+            from simulator import SimulatedFlimLabsApi
+            self.api = SimulatedFlimLabsApi(bins=bins, bin_offset=bin_offset, channels=channels,
+                                            counter_is_index=counter_is_index)
+        else:
+            from flim_labs_api import FlimLabsApi
+            self.api = FlimLabsApi()
+        self.api.set_consumer_handler(self.ingestor.push)
+        self.batcher = MacroTimeBatcher(batch_seconds)
+        self.slice_ns = SLICE_SECONDS * 1e9
+        self.kind = None
+        self.recorder = None
+
+    def run(self, commands):
+        metrics_deadline = time.perf_counter() + self.metrics_interval
+        while True:
+            if time.perf_counter() >= metrics_deadline:
+                metrics_deadline += self.metrics_interval
+                self.events.put(('metrics', flatten(self.metrics.snapshot())))
+            try:
+                command = commands.get(timeout=self.ingestor.flush_interval)
+            except queue.Empty:
+                self.publish_rates()
+                continue
+            if command is None:
+                break
+            try:
+                getattr(self, command[0])(*command[1:])
+            except Exception as e:
+                self.events.put(('error', f'{command[0]}: {e!r}'))
+        self.stop()
+        self.ingestor.close()
+        self.histograms.close()
+
+    def publish_rates(self):
+        self.histograms.set_rates(self.ingestor.total_photons, self.ingestor.photons_per_second)
+
+    def basis(self, version, basis):
+        self.histograms.set_basis(basis, version)
+
+    def batch_seconds(self, batch_seconds):
+        self.batcher.set_batch_seconds(batch_seconds)
+
+    # new bins or bin offset: the GUI created a new shared block
+    def attach(self, spec, basis, bin_offset):
+        self.histograms.close()
+        self.histograms = SharedHistogramStore.attach(spec, basis, self.metrics)
+        self.events.put(('attached', spec[0]))
+        self.ingestor.bins = self.histograms.bins
+        self.ingestor.bin_offset = bin_offset
+        if hasattr(self.api, 'bin_offset'):
+            self.api.bins = self.histograms.bins
+            self.api.bin_offset = bin_offset
+
+    # recording: (path, metadata) of an EventRecorder of the raw photon events, or None
+    def start(self, kind, firmware, laser_mhz, acquisition_time_seconds, recording=None):
+        self.ingestor.reset()
+        self.batcher.reset()
+        if recording is not None:
+            path, metadata = recording
+            self.recorder = EventRecorder(path, **metadata)
+        self.kind = kind
+        self.api.set_firmware(firmware)
+        self.api.acquire_spectroscopy(laser_frequency_mhz=laser_mhz,
+                                      acquisition_time_seconds=acquisition_time_seconds)
+
+    def stop(self):
+        self.api.stop_acquisition()
+        self.ingestor.flush()
+        self.kind = None
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+        self.publish_rates()
+        self.events.put(('stopped', self.batcher.last_macro_time))
+
+    def measure_frequency(self, firmware):
+        self.api.set_consumer_handler(self.receive_measure)
+        self.api.set_firmware(firmware)
+        self.api.acquire_measure_frequency()
+
+    def receive_measure(self, frequency):
+        self.events.put(('frequency', frequency))
+        self.api.stop_acquisition()
+        self.api.set_consumer_handler(self.ingestor.push)
+
+    def receive_chunk(self, counts, chunk):
+        kind = self.kind
+        recorder = self.recorder
+        if recorder is not None and kind is not None:
+            recorder.append(chunk)
+        if kind == 'reference':
+            self.histograms.add('reference', counts)
+        elif kind == 'data':
+            # slices and closed batches go to the GUI through the event queue
+            self.batcher.fold(chunk, counts, self.ingestor.histogram, lambda part: self.histograms.add('data', part),
+                              lambda end: self.events.put(('batch', *self.histograms.writer_snapshot(), end)),
+                              lambda index, part: self.events.put(('slice', index, part)), self.slice_ns)
+
+
+def run_acquisition(spec, basis, bin_offset, channels, batch_seconds, simulate, commands, events, overflow='block',
+                    counter_is_index=False):
+    AcquisitionWorker(spec, basis, bin_offset, channels, batch_seconds, simulate, events, overflow,
+                      counter_is_index).run(commands)
+
+
+class AcquisitionProcess:
+    """GUI-side handle of an acquisition running in a separate process.
+
+    The histograms are a SharedHistogramStore mapped from the shared block, so
+    a slow redraw never throttles photon handling. Commands go to the process
+    through a queue; closed data batches, frequency measures and the end of
+    every acquisition come back on an event queue read by a listener thread,
+    which appends the batches to `batches` like the in-process acquisition,
+    the measured frequencies to `frequencies` and the slice counts to the
+    `slices` SliceHistory. The GUI consumes them from its own thread.
+    """
+
+    def __init__(self, names=('reference', 'data'), bins=256, bin_offset=90, basis=None, channels=(1,),
+                 batch_seconds=5, simulate=False, batches=None, max_harmonics=10, overflow='block', slices=None,
+                 frequencies=None, counter_is_index=False):
+        # spawn: no fork of the Qt process, and the same behaviour on Windows and Linux
+        context = multiprocessing.get_context('spawn')
+        self.commands = context.Queue()
+        self.events = context.Queue()
+        self.batches = deque() if batches is None else batches
+        self.frequencies = deque() if frequencies is None else frequencies
+        self.slices = slices
+        self.max_harmonics = max_harmonics
+        self.histograms = SharedHistogramStore(names, bins, basis, len(channels), max_harmonics,
+                                               commands=self.commands)
+        # blocks replaced by set_layout, unlinked once the process has attached to the new one
+        self._retired = []
+        self.last_macro_time = 0.0
+        self.errors = []
+        # last flat metrics snapshot of the process
+        self.metrics = {}
+        self._stopped = threading.Event()
+        self.process = context.Process(target=run_acquisition, daemon=True,
+                                       args=(self.histograms.spec(), self.histograms.basis, bin_offset,
+                                             tuple(channels), batch_seconds, simulate, self.commands,
+                                             self.events, overflow, counter_is_index))
+        self.process.start()
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    @property
+    def photons_per_second(self):
+        return self.histograms.photons_per_second
+
+    def set_batch_seconds(self, batch_seconds):
+        self.commands.put(('batch_seconds', batch_seconds))
+
+    # histograms restart empty in a new shared block; returns the new store
+    def set_layout(self, bins, bin_offset, basis):
+        old = self.histograms
+        self.histograms = SharedHistogramStore(old.names, bins, basis, old.channels, self.max_harmonics,
+                                               commands=self.commands)
+        self.commands.put(('attach', self.histograms.spec(), basis, bin_offset))
+        self._retired.append(old)
+        return self.histograms
+
+    def start(self, kind, firmware, laser_mhz, acquisition_time_seconds, recording=None):
+        self._stopped.clear()
+        self.commands.put(('start', kind, firmware, laser_mhz, acquisition_time_seconds, recording))
+
+    # returns once the process has folded its last photons and sent the batches they closed
+    def stop(self, timeout=10):
+        self._stopped.clear()
+        self.commands.put(('stop',))
+        deadline = time.perf_counter() + timeout
+        while not self._stopped.wait(0.1) and self.process.is_alive() and time.perf_counter() < deadline:
+            pass
+
+    # the measured frequency is appended to `frequencies`
+    def measure_frequency(self, firmware):
+        self.commands.put(('measure_frequency', firmware))
+
+    def close(self, timeout=10):
+        if self.process.is_alive():
+            self.commands.put(None)
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.events.put(None)
+        self._listener.join()
+        for store in self._retired:
+            store.close()
+        self._retired = []
+        self.histograms.close()
+
+    def _listen(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            kind = event[0]
+            if kind == 'batch':
+                snapshot, version, end = event[1:]
+                self.batches.append((snapshot._replace(basis=self.histograms.basis_of(version)), end))
+            elif kind == 'slice':
+                if self.slices is not None:
+                    self.slices.add(*event[1:])
+            elif kind == 'attached':
+                # blocks are attached in the order they were created
+                while self._retired and self._retired[0].shm.name != event[1]:
+                    self._retired.pop(0).close()
+            elif kind == 'stopped':
+                self.last_macro_time = event[1]
+                self._stopped.set()
+            elif kind == 'frequency':
+                self.frequencies.append(event[1])
+            elif kind == 'metrics':
+                self.metrics = event[1]
+            elif kind == 'error':
+                self.errors.append(event[1])
@@ -0,0 +1,124 @@
+"""Single binary container for the data batches of an acquisition.
+
+Every closed batch is one record holding its (bins,) histogram next to its
+metadata: start and end macro time, photon count and g, s, m, phi. Records are
+appended by a background thread into the memory-mapped container of
+EventRecorder, so the GUI thread never waits on the disk. The text files of
+earlier versions can still be produced from a batch file:
+
+    python batch_store.py data_batches_20240101-120000.bin --text
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from recorder import EventRecorder, read_records
+
+BATCH_MAGIC = b'FLIMBTCH'
+
+
+# one record per batch; start_ns and end_ns are macro times of the batch boundaries.
+# With several channels photons, g, s, m, phi and histogram have a channel axis.
+def batch_dtype(bins=256, channels=1):
+    shape = () if channels == 1 else (channels,)
+    return np.dtype([
+        ('start_ns', '<f8'),
+        ('end_ns', '<f8'),
+        ('photons', '<i8', shape),
+        ('g', '<f8', shape),
+        ('s', '<f8', shape),
+        ('m', '<f8', shape),
+        ('phi', '<f8', shape),
+        ('histogram', '<u4', shape + (bins,)),
+    ])
+
+
+class BatchRecorder(EventRecorder):
+    """Appends batch records to a batch file from a background writer thread.
+
+    append only queues the record; close waits for the queued records to be
+    written and finalizes the header. With a Metrics registry the write time
+    of every record is recorded.
+    """
+
+    magic = BATCH_MAGIC
+
+    def __init__(self, path, laser_mhz, firmware, bin_offset, bins=256, channels=(1,), segment_batches=1024,
+                 metrics=None, **metadata):
+        self.dtype = batch_dtype(bins, len(channels))
+        self.metrics = metrics
+        super().__init__(path, laser_mhz, firmware, bin_offset, bins, segment_events=segment_batches,
+                         channels=list(channels), **metadata)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    # histogram: (channels, bins); g, s, m, phi: (channels,)
+    def append(self, start_ns, end_ns, histogram, g, s, m, phi):
+        record = np.zeros(1, dtype=self.dtype)
+        record['start_ns'] = start_ns
+        record['end_ns'] = end_ns
+        record['photons'] = histogram.sum(axis=-1)
+        record['g'], record['s'], record['m'], record['phi'] = g, s, m, phi
+        record['histogram'] = histogram
+        self._queue.put(record)
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            start = time.perf_counter()
+            super().append(record)
+            if self.metrics is not None:
+                self.metrics.observe('batch_write', time.perf_counter() - start)
+
+    # records queued and not written yet
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        super().close()
+
+
+def read_batches(path):
+    return read_records(path, BATCH_MAGIC)
+
+
+# optional conversion to one data_batch_N.txt file (time in ns, counts of every channel) per batch
+def export_text(path, directory='.'):
+    metadata, batches = read_batches(path)
+    x_data = np.linspace(0, 1000 / metadata['laser_mhz'], metadata['bins'])
+    for n, histogram in enumerate(batches['histogram']):
+        np.savetxt(os.path.join(directory, f'data_batch_{n}.txt'), np.vstack((x_data, histogram)).T)
+    names = ('start_ns', 'end_ns', 'photons', 'g', 's', 'm', 'phi')
+    channels = metadata.get('channels', [1])
+    header = [name if batches[name].ndim == 1 else ' '.join(f'{name}_ch{c}' for c in channels) for name in names]
+    np.savetxt(os.path.join(directory, 'data_batches.txt'), np.column_stack([batches[name] for name in names]),
+               header=' '.join(header))
+    return len(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or convert a batch file')
+    parser.add_argument('path', help='batch file')
+    parser.add_argument('--text', action='store_true', help='write data_batch_N.txt files and data_batches.txt')
+    parser.add_argument('--directory', default='.', help='output directory of --text')
+    args = parser.parse_args()
+
+    metadata, batches = read_batches(args.path)
+    print(f'{len(batches)} batches, {int(batches["photons"].sum()):,} photons, {metadata["bins"]} bins')
+    if args.text:
+        export_text(args.path, args.directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""Benchmarks for ingestion throughput, refresh latency, phasor cost and memory.
+
+Runs on a plain Linux box: photons come from SimulatedFlimLabsApi and the GUI
+is created on the offscreen Qt platform. Results are printed as JSON (and
+written to --output) so that runs can be compared.
+
+    python benchmark.py --duration 60 --rate 2000000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import psutil
+
+from histogram_store import HistogramStore
+from ingestion import OVERFLOW_POLICIES, PhotonIngestor, histogram_bins
+from lifetime_fit import LifetimeFitter
+from phasor_engine import PhasorEngine
+from simulator import SimulatedFlimLabsApi
+from slice_history import SliceHistory
+
+
+def percentiles_ms(samples):
+    if not samples:
+        return {'p50': None, 'p99': None}
+    samples = np.asarray(samples) * 1000
+    return {'p50': float(np.percentile(samples, 50)), 'p99': float(np.percentile(samples, 99))}
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_ingestion(photons):
+    source = SimulatedFlimLabsApi(photon_rate=photons, seed=0)
+    events = source.generate_events(0, 1e9, 40)
+    store = HistogramStore(('data',), basis=PhasorEngine().basis)
+    ingestor = PhotonIngestor(lambda counts, chunk: store.add('data', counts))
+
+    # per-photon consumer handler path, as called by the FlimLabsApi
+    rows = list(zip(*(values.tolist() for values in events)))
+    push = ingestor.push
+    start = time.perf_counter()
+    for row in rows:
+        push(*row)
+    ingestor.flush()
+    per_photon = len(rows) / (time.perf_counter() - start)
+
+    # vectorized path, used by replay and simulated chunk sources
+    start = time.perf_counter()
+    ingestor.push_chunk(*events)
+    chunked = len(rows) / (time.perf_counter() - start)
+    return {'photons': len(rows), 'push_events_per_s': per_photon, 'push_chunk_events_per_s': chunked}
+
+
+# overload: a sink that needs fold_ms per chunk of 4096 photons, fed at full speed with 1% of
+# the events lost upstream; reports what every overflow policy kept, dropped and lost. The events are
+# numbered one by one so that the ingestor can count the lost ones
+def bench_overload(photons, fold_ms=20):
+    events = SimulatedFlimLabsApi(photon_rate=photons, loss=0.01, counter_is_index=True,
+                                  seed=0).generate_events(0, 1e9, 40)
+    rows = list(zip(*(values.tolist() for values in events)))
+    # the phasor of every policy is compared with the one of all the delivered photons
+    engine = PhasorEngine()
+    full = engine.compute(np.bincount(histogram_bins(events[1]), minlength=256))
+    results = []
+    for overflow in OVERFLOW_POLICIES:
+        total = np.zeros((1, 256), dtype=np.int64)
+
+        def sink(counts, chunk):
+            total[:] += counts
+            time.sleep(fold_ms / 1000)
+
+        ingestor = PhotonIngestor(sink, chunk_size=4096, queue_chunks=4, overflow=overflow, counter_is_index=True)
+        start = time.perf_counter()
+        for row in rows:
+            ingestor.push(*row)
+        ingestor.flush()
+        elapsed = time.perf_counter() - start
+        ingestor.close()
+        phasor = engine.compute(total[0])
+        results.append({'overflow': overflow, 'delivered': len(rows), 'seconds': elapsed,
+                        'histogram_photons': int(total.sum()), **ingestor.losses(),
+                        'g_error': float(phasor.g - full.g), 's_error': float(phasor.s - full.s)})
+    return results
+
+
+# re-windowing of an acquisition of `seconds` kept in 100 ms slices: the first window size
+# computes the prefix phasor sums, the next ones only take differences of their rows
+def bench_rewindow(seconds=3600, windows=(1, 5, 0.5, 10), bins=256):
+    slices = SliceHistory(1, bins)
+    rng = np.random.default_rng(0)
+    counts = rng.poisson(100, size=(100, 1, bins))
+    for index in range(int(seconds * 10)):
+        slices.add(index, counts[index % len(counts)])
+    slices.flush()
+    basis = PhasorEngine(bins=bins).basis
+    results = []
+    for window in windows:
+        for step in (None, 0.1):
+            start = time.perf_counter()
+            starts = slices.window_sums(basis, window, step)[0]
+            results.append({'window_s': window, 'step_s': step, 'windows': len(starts),
+                            'ms': (time.perf_counter() - start) * 1000})
+    return {'seconds': seconds, 'slices': slices.slices, 'memory_mb': slices.nbytes / 2 ** 20,
+            'rewindow': results}
+
+
+def bench_phasor(histograms, bins_list=(256, 1024, 4096), harmonics_list=(1, 2, 4, 8), repeat=20):
+    results = []
+    rng = np.random.default_rng(0)
+    for bins in bins_list:
+        stack = rng.poisson(100, size=(histograms, bins)).astype(np.float64)
+        for harmonics in harmonics_list:
+            engine = PhasorEngine(bins=bins, harmonics=harmonics)
+            engine.calibrate(stack[0])
+            samples = timed(lambda: engine.compute_harmonics(stack), repeat)
+            results.append({'bins': bins, 'harmonics': harmonics, 'histograms': histograms,
+                            **percentiles_ms(samples)})
+    return results
+
+
+def bench_fitting(batches, workers_list=(1, 2, 4)):
+    # bi-exponential batch decays against a 4 ns reference, fitted on pools of growing size
+    def decay(taus, photons, seed):
+        events = SimulatedFlimLabsApi(photon_rate=photons, taus=taus, seed=seed).generate_events(0, 1e9, 40)
+        return np.bincount(histogram_bins(events[1]), minlength=256)[None].astype(np.float64)
+
+    reference = decay((4.0,), 1_000_000, 0)
+    histograms = [decay((1.0, 4.0), 100_000, seed) for seed in range(1, batches + 1)]
+    results = []
+    for workers in workers_list:
+        fitter = LifetimeFitter(components=2, workers=workers)
+        # warm the pool up with one task per worker, so that every worker is spawned before the
+        # clock starts
+        for key in range(workers):
+            fitter.submit(-1 - key, histograms[0], reference, 25.0, 4.0)
+        while fitter.pending:
+            time.sleep(0.01)
+        start = time.perf_counter()
+        for key, histogram in enumerate(histograms):
+            fitter.submit(key, histogram, reference, 25.0, 4.0)
+        while fitter.pending:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        fitter.close()
+        results.append({'workers': workers, 'batches': batches, 'fits_per_s': batches / elapsed})
+    return results
+
+
+# cold start of a fresh interpreter importing each module: wall time of the whole process
+# and of the import alone, and whether Qt or matplotlib were loaded on the way
+def bench_cold_start(modules=('headless', 'phasor'), runs=5):
+    code = ('import sys, time; start = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - start, any(name.split(".")[0] in ("PyQt5", "matplotlib") '
+            'for name in sys.modules))')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        process_times, import_times = [], []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', code.format(module)], cwd=directory, check=True,
+                                    capture_output=True, text=True).stdout.split()
+            process_times.append(time.perf_counter() - start)
+            import_times.append(float(output[0]))
+        results.append({'module': module, 'runs': runs, 'process_ms': percentiles_ms(process_times)['p50'],
+                        'import_ms': percentiles_ms(import_times)['p50'], 'gui_modules': output[1] == 'True'})
+    return results
+
+
+def bench_gui(duration, rate, frames):
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+
+    # the QApplication must exist before phasor selects the Qt5Agg backend
+    app = QApplication.instance() or QApplication(sys.argv)
+    import phasor
+
+    window = phasor.MainWindow(simulate=True)
+    window.api.photon_rate = rate
+    window.refresh_spinbox.setValue(1)
+    window.acquisition_time_in_seconds_data = int(duration) + 1
+    process = psutil.Process()
+    rss = []
+
+    # long acquisition through the real consumer path and frame scheduler
+    QTimer.singleShot(0, window.start_button_data.click)
+    sampler = QTimer()
+    sampler.timeout.connect(lambda: rss.append(process.memory_info().rss))
+    sampler.start(250)
+    QTimer.singleShot(int(duration * 1000), window.stop_button_data.click)
+    QTimer.singleShot(int(duration * 1000) + 200, app.quit)
+    start = time.perf_counter()
+    app.exec_()
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+    acquisition = {
+        'duration_s': elapsed,
+        'photons_generated': window.api.photons_sent,
+        'photons_received': window.points_received,
+        'events_per_s': window.points_received / elapsed,
+        'frames': window.scheduler.frames,
+        'batches': window.batch_counter,
+        'peak_rss_mb': max(rss, default=process.memory_info().rss) / 2 ** 20,
+        'rss_growth_mb': (rss[-1] - rss[0]) / 2 ** 20 if len(rss) > 1 else 0.0,
+    }
+
+    # refresh latency of every view, and draw latency of every canvas as seen by its renderer
+    renderers = {'canvas1': window.renderer1, 'canvas2': window.renderer2, 'canvas3': window.renderer3}
+    for renderer in renderers.values():
+        renderer.frame_times.clear()
+    refresh = {
+        'refresh_histogram_ref': percentiles_ms(timed(window.refresh_histogram_ref, frames)),
+        'refresh_histogram': percentiles_ms(timed(window.refresh_histogram, frames)),
+        'update_canvas2': percentiles_ms(timed(window.update_canvas2, frames)),
+    }
+    draw = {name: percentiles_ms(list(renderer.frame_times)) for name, renderer in renderers.items()}
+    window.close()
+    return acquisition, refresh, draw
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Phasor GUI benchmarks')
+    parser.add_argument('--duration', type=float, default=30, help='simulated acquisition length (s)')
+    parser.add_argument('--rate', type=int, default=1_000_000, help='simulated photon rate (photons/s)')
+    parser.add_argument('--photons', type=int, default=1_000_000, help='photons of the ingestion benchmark')
+    parser.add_argument('--histograms', type=int, default=1000, help='stacked histograms of the phasor benchmark')
+    parser.add_argument('--frames', type=int, default=100, help='refreshes timed per view')
+    parser.add_argument('--fits', type=int, default=200, help='batch decays of the lifetime fitting benchmark')
+    parser.add_argument('--cold-start-runs', type=int, default=5, help='interpreter starts timed per module')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+
+    # interpreter starts are timed first, before any worker process of the other benchmarks
+    cold_start = bench_cold_start(runs=args.cold_start_runs)
+    # the GUI writes its batch and histogram files in the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            acquisition, refresh, draw = bench_gui(args.duration, args.rate, args.frames)
+        finally:
+            os.chdir(cwd)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'ingestion': bench_ingestion(args.photons),
+        'overload': bench_overload(args.photons // 4),
+        'phasor': bench_phasor(args.histograms),
+        'rewindow': bench_rewindow(),
+        'fitting': bench_fitting(args.fits),
+        'cold_start': cold_start,
+        'acquisition': acquisition,
+        'refresh_ms': refresh,
+        'draw_ms': draw,
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
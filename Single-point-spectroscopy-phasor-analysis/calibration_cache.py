@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+import numpy as np
+
+
+class CalibrationCache:
+    """Reference histograms and instrument calibrations kept across sessions.
+
+    Entries are keyed by laser frequency, harmonic, bins, bin offset,
+    reference lifetimes and channels, and saved to a JSON file whenever one
+    is stored. Each entry holds the reference histogram; PhasorEngine derives
+    phi_instr and m_instr from it when it calibrates. The reference histogram
+    only depends on the laser frequency, bins, bin offset and channels, so
+    find() falls back to the latest entry with the same layout when the
+    harmonic or the reference lifetimes have no entry of their own. Key values
+    are normalized, so 40 and 40.0 MHz are the same entry.
+    """
+
+    def __init__(self, path='calibration_cache.json'):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+                # keys written before they were normalized
+                self.entries = {self.key(*json.loads(key)): entry for key, entry in entries.items()}
+            except (OSError, ValueError, TypeError):
+                self.entries = {}
+
+    @staticmethod
+    def key(laser_mhz, harmonic, bins, bin_offset, tau_phase_reference, tau_modulation_reference, channels=(1,)):
+        return json.dumps([float(laser_mhz), int(harmonic), int(bins), int(bin_offset), float(tau_phase_reference),
+                           float(tau_modulation_reference), [int(channel) for channel in channels]])
+
+    # the part of the key the reference histogram depends on: laser, bins, bin offset, channels
+    @staticmethod
+    def layout(key):
+        laser_mhz, harmonic, bins, bin_offset, tau_phase, tau_modulation, channels = json.loads(key)
+        return laser_mhz, bins, bin_offset, channels
+
+    def store(self, key, reference):
+        self.entries[key] = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'reference': np.asarray(reference, dtype=np.float64).tolist(),
+        }
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temporary, self.path)
+
+    # reference histogram for key: from its own entry, else from the latest entry with the same layout
+    def find(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            layout = self.layout(key)
+            matches = [entry for other, entry in self.entries.items() if self.layout(other) == layout]
+            if not matches:
+                return None
+            entry = max(matches, key=lambda entry: entry['time'])
+        return np.array(entry['reference'], dtype=np.float64)
@@ -0,0 +1,128 @@
+import atexit
+import importlib.util
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# formats of save_columns; parquet needs pyarrow and xlsx needs pandas with openpyxl
+EXPORT_FORMATS = ('csv', 'parquet', 'xlsx')
+
+
+def available_formats():
+    formats = ['csv']
+    if importlib.util.find_spec('pyarrow') is not None:
+        formats.append('parquet')
+    if importlib.util.find_spec('pandas') is not None and importlib.util.find_spec('openpyxl') is not None:
+        formats.append('xlsx')
+    return formats
+
+
+def default_format():
+    return 'parquet' if 'parquet' in available_formats() else 'csv'
+
+
+# columns: dict of equally long 1-D arrays; progress(fraction) is called while writing
+def write_csv(path, columns, progress, rows_per_block=10000):
+    table = np.column_stack([np.asarray(values, dtype=np.float64) for values in columns.values()])
+    with open(path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for start in range(0, len(table), rows_per_block):
+            np.savetxt(f, table[start:start + rows_per_block], delimiter=',', fmt='%.10g')
+            progress(min(start + rows_per_block, len(table)) / len(table))
+
+
+def write_parquet(path, columns, progress):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pq.write_table(pa.table({name: np.asarray(values) for name, values in columns.items()}), path)
+
+
+def write_xlsx(path, columns, progress):
+    import pandas as pd
+
+    pd.DataFrame(columns).to_excel(path, index=False)
+
+
+WRITERS = {'csv': write_csv, 'parquet': write_parquet, 'xlsx': write_xlsx}
+
+
+class BackgroundExporter:
+    """Writes export files from a worker thread, one job at a time.
+
+    The GUI only queues jobs with copies of the data to write and polls
+    status and progress. Exports queued when the window closes are still
+    written before the interpreter exits; a failed export is reported in
+    status instead of raising on the GUI thread.
+    With a Metrics registry the write time of every export and the failed
+    ones are recorded.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.status = 'idle'
+        self.progress = 1.0
+        self.pending = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.join)
+
+    # write(path, *args, progress) runs on the worker thread
+    def submit(self, path, write, *args):
+        with self._lock:
+            self.pending += 1
+        self._queue.put((path, write, args))
+
+    # path without extension, the extension of the format is added
+    def save_columns(self, path, columns, fmt='csv'):
+        path = f'{path}.{fmt}'
+        self.submit(path, WRITERS[fmt], {name: np.array(values) for name, values in columns.items()})
+        return path
+
+    def save_text(self, path, table):
+        self.submit(path, lambda path, table, progress: np.savetxt(path, table), np.array(table))
+
+    # no job can be queued afterwards; the queued ones are still written
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+
+    def join(self):
+        self.close()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            path, write, args = job
+            name = os.path.basename(path)
+            self.progress = 0.0
+            self.status = f'writing {name}'
+            start = time.perf_counter()
+            try:
+                write(path, *args, progress=self._set_progress)
+                self.status = f'saved {name}'
+            except Exception as e:
+                self.errors.append((path, e))
+                self.status = f'failed {name}: {e}'
+                if self.metrics is not None:
+                    self.metrics.inc('export_errors')
+            if self.metrics is not None:
+                self.metrics.observe('export', time.perf_counter() - start)
+            self.progress = 1.0
+            with self._lock:
+                self.pending -= 1
+
+    def _set_progress(self, fraction):
+        self.progress = fraction
@@ -0,0 +1,319 @@
+"""Calibration, acquisition and phasor batching from the command line, without the GUI.
+
+Nothing here imports Qt or matplotlib. Photons go through the same
+PhotonIngestor, MacroTimeBatcher, HistogramStore and PhasorEngine as the GUI
+and the results are written to the same files: the batch file, phasors_data
+and the Reference_TCSPC.txt / Data_TCSPC.txt histograms. The calibration comes
+from calibration_cache.json unless --reference-seconds asks for a new
+reference acquisition, which then replaces the cached one. With --windows the
+phasors are also exported for other window lengths, recomputed from the 100 ms
+slices of the acquisition.
+
+    python headless.py --reference-seconds 20 --data-seconds 60 --batch-seconds 5 --windows 1 10
+"""
+import argparse
+import time
+from collections import deque
+
+import numpy as np
+
+from batch_store import BatchRecorder
+from calibration_cache import CalibrationCache
+from exporter import BackgroundExporter, available_formats, default_format
+from histogram_store import HistogramStore
+from ingestion import OVERFLOW_POLICIES, MacroTimeBatcher, PhotonIngestor, default_bin_offset
+from lifetime_fit import MAX_COMPONENTS, LifetimeFitter
+from phasor_engine import PhasorEngine
+from phasor_history import PhasorHistory
+from slice_history import SliceHistory
+
+
+class HeadlessAcquisition:
+    """Reference and data acquisitions of the GUI driven from a plain loop.
+
+    The api consumer thread folds photons into the histogram store and queues
+    a snapshot at every batch boundary, as in the GUI; acquire() records the
+    closed batches from the calling thread while it waits for the acquisition
+    to end. With fit_components the batch decays are fitted on a process pool
+    like in the GUI.
+    """
+
+    def __init__(self, laser_mhz=40, bins=256, channels=(1,), harmonic=1, harmonics=2, tau_phase_reference=4,
+                 tau_modulation_reference=4, batch_seconds=5, firmware='firmwares\\spectroscopy_40MHz.flim',
+                 simulate=False, calibrations='calibration_cache.json', fit_components=0, overflow='block',
+                 counter_is_index=False, poll_interval=0.05):
+        self.laser_mhz = laser_mhz
+        self.bins = bins
+        self.bin_offset = default_bin_offset(bins)
+        self.channels = tuple(channels)
+        self.harmonic = harmonic
+        self.tau_phase_reference = tau_phase_reference
+        self.tau_modulation_reference = tau_modulation_reference
+        self.firmware = firmware
+        self.poll_interval = poll_interval
+
+        self.engine = PhasorEngine(laser_mhz=laser_mhz, bins=bins, harmonic=harmonic, harmonics=harmonics,
+                                   tau_phase_reference=tau_phase_reference,
+                                   tau_modulation_reference=tau_modulation_reference)
+        self.calibrations = CalibrationCache(calibrations)
+        self.reference = None
+        self.histograms = HistogramStore(('reference', 'data'), bins=bins, basis=self.engine.basis,
+                                         channels=len(self.channels))
+        self.ingestor = PhotonIngestor(self.receive_chunk, bins=bins, bin_offset=self.bin_offset,
+                                       channels=self.channels, overflow=overflow, counter_is_index=counter_is_index)
+        self.batcher = MacroTimeBatcher(batch_seconds)
+        if simulate:
+            from simulator import SimulatedFlimLabsApi
+            self.api = SimulatedFlimLabsApi(bins=bins, bin_offset=self.bin_offset, channels=self.channels,
+                                            counter_is_index=counter_is_index)
+        else:
+            from flim_labs_api import FlimLabsApi
+            self.api = FlimLabsApi()
+        self.api.set_consumer_handler(self.ingestor.push)
+
+        # histogram the consumer thread folds photons into, None between acquisitions
+        self.kind = None
+        self.closed_batches = deque()
+        self.batch_baseline = None
+        self.batch_start_ns = 0.0
+        self.batch_recorder = None
+        self.slices = SliceHistory(len(self.channels), bins)
+        self.fit_columns = ([f'tau_{k}' for k in range(1, MAX_COMPONENTS + 1)]
+                            + [f'a_{k}' for k in range(1, MAX_COMPONENTS + 1)] + ['chi2'])
+        self.phasor_history = PhasorHistory(('channel', 'start_ns', 'end_ns', 'photons', 'g', 's', 'm', 'phi',
+                                             *self.fit_columns))
+        self.fitter = LifetimeFitter(components=fit_components) if fit_components else None
+
+    @property
+    def period_ns(self):
+        return 1000 / self.laser_mhz
+
+    def calibration_key(self):
+        return CalibrationCache.key(self.laser_mhz, self.harmonic, self.bins, self.bin_offset,
+                                    self.tau_phase_reference, self.tau_modulation_reference, self.channels)
+
+    # calibrates on the cached reference of the current settings; False when there is none
+    def restore_calibration(self):
+        reference = self.calibrations.find(self.calibration_key())
+        if reference is None or reference.shape != (len(self.channels), self.bins):
+            return False
+        self.reference = reference
+        self.engine.calibrate(reference)
+        return True
+
+    def calibrate(self, seconds):
+        baseline = self.histograms.snapshot()
+        self.acquire('reference', seconds)
+        snapshot = self.histograms.snapshot()
+        self.reference = snapshot.histograms['reference'] - baseline.histograms['reference']
+        self.engine.calibrate(self.reference)
+        self.calibrations.store(self.calibration_key(), self.reference)
+        return self.reference
+
+    # data acquisition cut into batches; returns the (channels, bins) histogram of the whole acquisition
+    def measure(self, seconds, batch_path=None):
+        baseline = self.batch_baseline = self.histograms.snapshot()
+        self.batch_start_ns = 0.0
+        self.slices.reset()
+        if batch_path:
+            self.batch_recorder = BatchRecorder(batch_path, laser_mhz=self.laser_mhz, firmware=self.firmware,
+                                                bin_offset=self.bin_offset, bins=self.bins,
+                                                channels=self.channels, harmonic=self.harmonic)
+        try:
+            self.acquire('data', seconds)
+            # the partial batch left open by the last photons
+            snapshot = self.histograms.snapshot()
+            if snapshot.totals['data'].sum() > self.batch_baseline.totals['data'].sum():
+                self.save_batch(snapshot, self.batcher.last_macro_time)
+            self.slices.flush()
+        finally:
+            recorder, self.batch_recorder = self.batch_recorder, None
+            if recorder is not None:
+                recorder.close()
+        return snapshot.histograms['data'] - baseline.histograms['data']
+
+    # runs one acquisition of `seconds` into the `kind` histogram and returns once its last
+    # photons are folded: the card stops on its own, the tail is waited for until photons stop
+    def acquire(self, kind, seconds, idle_seconds=0.5, grace_seconds=5):
+        self.ingestor.reset()
+        self.batcher.reset()
+        self.kind = kind
+        self.api.set_firmware(self.firmware)
+        self.api.acquire_spectroscopy(laser_frequency_mhz=self.laser_mhz, acquisition_time_seconds=seconds)
+        end = time.perf_counter() + seconds
+        while True:
+            time.sleep(self.poll_interval)
+            self.close_pending_batches()
+            now = time.perf_counter()
+            if now >= end + grace_seconds or (now >= end and self.ingestor.idle_time() >= idle_seconds):
+                break
+        self.api.stop_acquisition()
+        self.ingestor.flush()
+        self.close_pending_batches()
+        self.kind = None
+
+    def receive_chunk(self, counts, chunk):
+        if self.kind == 'reference':
+            self.histograms.add('reference', counts)
+        elif self.kind == 'data':
+            self.batcher.fold(chunk, counts, self.ingestor.histogram, lambda part: self.histograms.add('data', part),
+                              lambda end: self.closed_batches.append((self.histograms.snapshot(), end)),
+                              self.slices.add, self.slices.base_ns)
+
+    def close_pending_batches(self):
+        while self.closed_batches:
+            self.save_batch(*self.closed_batches.popleft())
+
+    # phasors of the batch closed at end_ns, from the running sums of the store
+    def save_batch(self, snapshot, end_ns):
+        basis = self.engine.basis
+        histogram = snapshot.histograms['data'] - self.batch_baseline.histograms['data']
+        sums = (self.histograms.phasor_sums(snapshot, 'data', basis)
+                - self.histograms.phasor_sums(self.batch_baseline, 'data', basis))
+        totals = snapshot.totals['data'] - self.batch_baseline.totals['data']
+        result = self.engine.compute_harmonics_from_sums(sums, totals)
+        h = self.harmonic - 1
+        g, s, m, phi = result.g[:, h], result.s[:, h], result.m[:, h], result.phi[:, h]
+        record = len(self.phasor_history)
+        for i, channel in enumerate(self.channels):
+            self.phasor_history.append(channel=channel, start_ns=self.batch_start_ns, end_ns=end_ns,
+                                       photons=totals[i], g=g[i], s=s[i], m=m[i], phi=phi[i])
+        if self.fitter is not None and self.reference is not None:
+            self.fitter.submit(record, histogram, self.reference, self.period_ns, self.tau_phase_reference)
+        if self.batch_recorder is not None:
+            self.batch_recorder.append(self.batch_start_ns, end_ns, histogram, g, s, m, phi)
+        self.batch_start_ns = end_ns
+        self.batch_baseline = snapshot
+
+    # waits for the fits still running and fills the fit columns of the history
+    def collect_fits(self):
+        fitter = self.fitter
+        if fitter is None:
+            return
+        while fitter.pending:
+            time.sleep(self.poll_interval)
+        while fitter.results:
+            record, fits = fitter.results.popleft()
+            for i, fit in enumerate(fits):
+                columns = {'chi2': fit.chi2}
+                for k, (tau, amplitude) in enumerate(zip(fit.taus, fit.amplitudes), 1):
+                    columns[f'tau_{k}'] = tau
+                    columns[f'a_{k}'] = amplitude
+                self.phasor_history.update(record + i, **columns)
+
+    # same columns as the phasors_data export of the GUI
+    def phasor_columns(self):
+        history = self.phasor_history
+        data = {'g_data': history.column('g'), 's_data': history.column('s'), 'm_fluo': history.column('m'),
+                'phi_fluo': history.column('phi')}
+        if len(self.channels) > 1:
+            data = {'channel': history.column('channel'), **data}
+        if np.isfinite(history.column('chi2')).any():
+            data.update({name: history.column(name) for name in self.fit_columns})
+        return data
+
+    # phasors_data columns of the windows of window_seconds every step_seconds (back to back without),
+    # from the slices of the last data acquisition
+    def window_columns(self, window_seconds, step_seconds=None):
+        starts, ends, sums, totals = self.slices.window_sums(self.engine.basis, window_seconds, step_seconds)
+        result = self.engine.compute_harmonics_from_sums(sums, totals)
+        h = self.harmonic - 1
+        data = {'start_s': np.repeat(starts, len(self.channels)) / 1e9,
+                'g_data': result.g[..., h].ravel(), 's_data': result.s[..., h].ravel(),
+                'm_fluo': result.m[..., h].ravel(), 'phi_fluo': result.phi[..., h].ravel()}
+        if len(self.channels) > 1:
+            data = {'channel': np.tile(self.channels, len(starts)), **data}
+        return data
+
+    def close(self):
+        self.api.stop_acquisition()
+        self.ingestor.close()
+        self.phasor_history.close()
+        if self.fitter is not None:
+            self.fitter.close()
+
+
+# what an acquisition lost, empty when nothing was
+def describe_losses(losses):
+    parts = []
+    if losses['lost']:
+        parts.append(f'{losses["lost"]:,} lost before the handler ({losses["gaps"]:,} counter gaps)')
+    if losses['overflow_dropped']:
+        parts.append(f'{losses["overflow_dropped"]:,} dropped on overflow')
+    if losses['decimated']:
+        parts.append(f'{losses["decimated"]:,} decimated (counts rescaled, last decimation 1/{losses["decimation"]})')
+    return '; ' + ', '.join(parts) if parts else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Phasor acquisition without the GUI')
+    parser.add_argument('--simulate', action='store_true', help='photons from the simulated source')
+    parser.add_argument('--laser-mhz', type=float, default=40)
+    parser.add_argument('--bins', type=int, default=256, choices=(256, 1024, 4096))
+    parser.add_argument('--channels', type=int, nargs='+', default=[1])
+    parser.add_argument('--harmonic', type=int, default=1)
+    parser.add_argument('--tau-phase', type=float, default=4, help='reference tau_phase (ns)')
+    parser.add_argument('--tau-modulation', type=float, default=4, help='reference tau_modulation (ns)')
+    parser.add_argument('--reference-seconds', type=float, default=0,
+                        help='length of a new reference acquisition, 0 to use the cached calibration')
+    parser.add_argument('--data-seconds', type=float, default=20, help='length of the data acquisition')
+    parser.add_argument('--batch-seconds', type=float, default=5)
+    parser.add_argument('--windows', type=float, nargs='*', default=[],
+                        help='other window lengths (s) to export the phasors for, as phasors_data_<window>s')
+    parser.add_argument('--window-step', type=float, help='step (s) of sliding windows, back to back without')
+    parser.add_argument('--fit', type=int, default=0, choices=range(MAX_COMPONENTS + 1),
+                        help='exponential components of the batch fits, 0 for no fit')
+    parser.add_argument('--overflow', default='block', choices=OVERFLOW_POLICIES,
+                        help='what happens to new photons when folding falls behind')
+    parser.add_argument('--counter-is-index', action='store_true',
+                        help='monotonic_counter numbers the events: count the lost ones from its gaps')
+    parser.add_argument('--format', default=default_format(), choices=available_formats(),
+                        help='format of phasors_data')
+    parser.add_argument('--firmware', default='firmwares\\spectroscopy_40MHz.flim')
+    args = parser.parse_args()
+
+    session = HeadlessAcquisition(laser_mhz=args.laser_mhz, bins=args.bins, channels=args.channels,
+                                  harmonic=args.harmonic, harmonics=max(2, args.harmonic),
+                                  tau_phase_reference=args.tau_phase, tau_modulation_reference=args.tau_modulation,
+                                  batch_seconds=args.batch_seconds, firmware=args.firmware, simulate=args.simulate,
+                                  fit_components=args.fit, overflow=args.overflow,
+                                  counter_is_index=args.counter_is_index)
+    exporter = BackgroundExporter()
+    x_data = np.linspace(0, session.period_ns, args.bins)
+    try:
+        if args.reference_seconds > 0:
+            reference = session.calibrate(args.reference_seconds)
+            print(f'reference: {int(reference.sum()):,} photons{describe_losses(session.ingestor.losses())}')
+            exporter.save_text('Reference_TCSPC.txt', np.vstack((x_data, reference)).T)
+        elif session.restore_calibration():
+            print('reference: cached calibration')
+        else:
+            print('reference: no cached calibration for these settings, the phasors are not calibrated')
+        if args.data_seconds > 0:
+            histogram = session.measure(args.data_seconds,
+                                        f'data_batches_{time.strftime("%Y%m%d-%H%M%S")}.bin')
+            session.collect_fits()
+            exporter.save_text('Data_TCSPC.txt', np.vstack((x_data, histogram)).T)
+            path = exporter.save_columns('phasors_data', session.phasor_columns(), args.format)
+            result = session.engine.compute(histogram)
+            print(f'data: {int(histogram.sum()):,} photons, {len(session.phasor_history) // len(session.channels)} '
+                  f'batches written to {path}{describe_losses(session.ingestor.losses())}')
+            for window in args.windows:
+                start = time.perf_counter()
+                columns = session.window_columns(window, args.window_step)
+                path = exporter.save_columns(f'phasors_data_{window:g}s', columns, args.format)
+                print(f'{len(columns["g_data"]) // len(session.channels)} windows of {window:g} s in '
+                      f'{(time.perf_counter() - start) * 1000:.1f} ms written to {path}')
+            for channel, g, s, tau_phase, tau_modulation in zip(session.channels, result.g, result.s,
+                                                                 result.tau_phase, result.tau_modulation):
+                print(f'channel {channel}: g = {g:.3f}  s = {s:.3f}  tau_phase = {tau_phase * 1e9:.3f} ns  '
+                      f'tau_modulation = {tau_modulation * 1e9:.3f} ns')
+    finally:
+        session.close()
+        exporter.join()
+    for path, error in exporter.errors:
+        print(f'{path} not written: {error}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+
+from slice_history import slice_counts
+
+
+# fields and dtypes of the buffered photon events
+EVENT_FIELDS = (('channel', np.int32), ('time_bin', np.int32), ('micro_time', np.float64),
+                ('monotonic_counter', np.int64), ('macro_time', np.float64))
+
+# what PhotonIngestor does with a filled chunk when its queue is full
+OVERFLOW_POLICIES = ('block', 'drop', 'decimate')
+MAX_DECIMATION = 1024
+
+
+# the 90 bins offset of the 256 bins firmware, as the same fraction of the laser period
+def default_bin_offset(bins):
+    return 90 * bins // 256
+
+
+# histogram bin of every photon: the firmware time bin shifted by the bin offset and wrapped
+def histogram_bins(time_bin, bins=256, bin_offset=90):
+    return (time_bin + bin_offset) % bins
+
+
+# row of every channel number in the (channels, bins) histograms, -1 for the channels not acquired
+def channel_table(channels):
+    table = np.full(max(channels) + 1, -1, dtype=np.intp)
+    table[list(channels)] = np.arange(len(channels))
+    return table
+
+
+# histogram row of every photon of `channel`, -1 for the photons of channels that are not acquired
+def channel_rows(channel, table):
+    channel = np.asarray(channel)
+    return np.where(channel < len(table), table[np.minimum(channel, len(table) - 1)], -1)
+
+
+class MacroTimeBatcher:
+    """Cuts the photon stream into batches of batch_seconds of macro time.
+
+    Boundaries sit at multiples of the batch length from the start of the
+    acquisition, on the macro_time hardware timestamp (ns) of every photon, so
+    the batches do not depend on when the GUI gets to run and are the same as
+    the ones of replay.fold_events. A new batch length takes effect from the
+    next boundary.
+    """
+
+    def __init__(self, batch_seconds=5):
+        self.set_batch_seconds(batch_seconds)
+        self.reset()
+
+    def set_batch_seconds(self, batch_seconds):
+        self.batch_ns = batch_seconds * 1e9
+
+    def reset(self):
+        self.batch_end = self.batch_ns
+        self.last_macro_time = 0.0
+
+    # end macro time of every batch closed by a chunk of increasing macro times, and
+    # the index where the chunk is cut; repeated indices are batches with no photon
+    def split(self, macro_time):
+        if len(macro_time) == 0:
+            return [], []
+        self.last_macro_time = macro_time[-1]
+        if macro_time[-1] < self.batch_end:
+            return [], []
+        ends = []
+        while macro_time[-1] >= self.batch_end:
+            ends.append(self.batch_end)
+            self.batch_end += self.batch_ns
+        return ends, np.searchsorted(macro_time, ends)
+
+    # folds a chunk of data photons cut on the batch boundaries: add(counts) is called with the
+    # (channels, bins) counts of every part of the chunk and closed(end) at every boundary, once the
+    # photons before it are added. counts is the histogram of the whole chunk, histogram(chunk,
+    # start, stop) the one of a part. With add_slice, add_slice(index, counts) is called first for
+    # every time slice of slice_ns the chunk touches
+    def fold(self, chunk, counts, histogram, add, closed, add_slice=None, slice_ns=None):
+        if add_slice is not None:
+            for index, part in slice_counts(chunk, counts, slice_ns, histogram):
+                add_slice(index, part)
+        ends, cuts = self.split(chunk['macro_time'])
+        start = 0
+        for end, cut in zip(ends, cuts):
+            if cut > start:
+                add(histogram(chunk, start, cut))
+            closed(end)
+            start = cut
+        if start < len(chunk['time_bin']):
+            add(counts if start == 0 else histogram(chunk, start))
+
+
+class PhotonIngestor:
+    """Buffers photon events coming from the FlimLabsApi consumer thread into
+    preallocated arrays and folds them into histograms one chunk at a time.
+
+    Histograms have one row per acquired channel: the photons of all the
+    channels are folded with a single bincount. With a single channel every
+    photon goes to that row, whatever channel number the firmware reports;
+    otherwise photons of channels that are not listed are dropped.
+
+    Filled chunks are queued to a fold thread that calls the sink. A partial
+    chunk is queued once flush_interval has passed, by the next push or, at
+    the end of an acquisition, by the fold thread itself once no photon came
+    for two intervals. A hand-off from another thread claims the chunk being
+    filled and never runs while a push writes to it, so no photon is lost to
+    it.
+
+    The queue is bounded by a pool of queue_chunks buffers; when the sink
+    falls behind and no buffer is free, `overflow` decides what happens to
+    the chunk just filled:
+    - 'block': the consumer thread waits for a buffer, and the events back up
+      in the API
+    - 'drop': the chunk is dropped and counted in overflow_dropped
+    - 'decimate': every other photon of the chunk is dropped, and from then
+      on only one photon of every `decimation` is kept. Folded counts are
+      multiplied by the decimation, so histogram totals and phasors stay
+      unbiased estimates. The decimation halves again once the queue drains.
+    The raw events given to the sink, and recorded by the GUI, are the kept
+    ones only.
+
+    The FlimLabsApi monotonic_counter accounts for the time passed since the
+    start of the acquisition, so it does not show lost events. Only with
+    counter_is_index, for a firmware whose counter numbers the events one by
+    one, are the events lost before the handler found from its gaps and
+    counted in lost_events and counter_gaps.
+
+    With a Metrics registry the ingestor records the folded and dropped
+    events, the buffer depth at every flush, the fold latency of every chunk
+    and the latency of one consumer callback every 1024. It also records the
+    overflow and counter losses, the queue depth and the time spent blocked.
+    """
+
+    def __init__(self, sink, bins=256, bin_offset=90, chunk_size=65536, flush_interval=0.05, channels=(1,),
+                 metrics=None, queue_chunks=8, overflow='block', counter_is_index=False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy {overflow!r}')
+        # sink(counts, chunk) is called on the fold thread with the (channels, bins) bincount of
+        # every chunk and a dict of views on its event fields; chunk['scale'] is its decimation
+        self.sink = sink
+        self.bins = bins
+        self.bin_offset = bin_offset
+        self.set_channels(channels)
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.queue_chunks = queue_chunks
+        self.overflow = overflow
+        self.counter_is_index = counter_is_index
+
+        # buffers of the filled chunks go to the fold thread through _ready and come back through _free
+        self._ready = queue.Queue()
+        # a thread other than the pushing one claims the chunk being filled by holding _lock and
+        # setting _claimed; it waits for _pushing to clear, and a push waits while it is claimed.
+        # Under the GIL the two flags cost the per-photon path much less than a lock
+        self._lock = threading.Lock()
+        self._claimed = False
+        self._pushing = False
+        self._free = queue.Queue()
+        for _ in range(queue_chunks):
+            self._free.put(self._allocate())
+        self._set_buffer(self._allocate())
+        # (macro time, missing events) of the last counter gaps
+        self.gaps = deque(maxlen=1000)
+        self.reset()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _allocate(self):
+        return {name: np.empty(self.chunk_size, dtype=dtype) for name, dtype in EVENT_FIELDS}
+
+    def _set_buffer(self, buffer):
+        self._buffer = buffer
+        self.channel = buffer['channel']
+        self.time_bin = buffer['time_bin']
+        self.micro_time = buffer['micro_time']
+        self.monotonic_counter = buffer['monotonic_counter']
+        self.macro_time = buffer['macro_time']
+
+    def set_channels(self, channels):
+        self.channels = tuple(channels)
+        self._channel_rows = channel_table(self.channels)
+
+    # (channels, bins) histogram of the photons start:stop of a chunk, rescaled by its decimation
+    def histogram(self, chunk, start=0, stop=None):
+        index = histogram_bins(chunk['time_bin'][start:stop], self.bins, self.bin_offset)
+        n_channels = len(self.channels)
+        if n_channels > 1:
+            rows = channel_rows(chunk['channel'][start:stop], self._channel_rows)
+            acquired = rows >= 0
+            index = rows[acquired] * self.bins + index[acquired]
+        counts = np.bincount(index, minlength=n_channels * self.bins).reshape(n_channels, self.bins)
+        scale = chunk.get('scale', 1)
+        return counts * scale if scale != 1 else counts
+
+    # only called between acquisitions, once the queued chunks are folded
+    def reset(self):
+        self._n = 0
+        self.total_photons = 0
+        self.photons_per_second = 0.0
+        self.peak_photons_per_second = 0.0
+        now = time.perf_counter()
+        self._deadline = now + self.flush_interval
+        self._last_push = now
+        self._rate_start = now
+        self._rate_photons = 0
+        self.decimation = 1
+        self._skip = 0
+        self._next_counter = None
+        self.lost_events = 0
+        self.counter_gaps = 0
+        self.overflow_dropped = 0
+        self.decimated_events = 0
+        self.gaps.clear()
+
+    # consumer handler: same signature as the FlimLabsApi spectroscopy callback
+    def push(self, channel, time_bin, micro_time, monotonic_counter, macro_time):
+        timed = self.metrics is not None and not self._n & 1023
+        if timed:
+            start = time.perf_counter()
+        self._pushing = True
+        try:
+            while self._claimed:
+                self._pushing = False
+                with self._lock:
+                    pass
+                self._pushing = True
+            if self.counter_is_index:
+                if monotonic_counter != self._next_counter:
+                    self._counter_gap(monotonic_counter, macro_time)
+                self._next_counter = monotonic_counter + 1
+            self._last_push = now = time.perf_counter()
+            if self._skip:
+                self._skip -= 1
+                self.decimated_events += 1
+                return
+            self._skip = self.decimation - 1
+            i = self._n
+            self.channel[i] = channel
+            self.time_bin[i] = time_bin
+            self.micro_time[i] = micro_time
+            self.monotonic_counter[i] = monotonic_counter
+            self.macro_time[i] = macro_time
+            self._n = i + 1
+            if self._n == self.chunk_size or now >= self._deadline:
+                self._hand_off()
+        finally:
+            self._pushing = False
+        if timed:
+            self.metrics.observe('callback', time.perf_counter() - start)
+
+    # events the hardware counted but the handler never got
+    def _counter_gap(self, monotonic_counter, macro_time):
+        expected = self._next_counter
+        if expected is not None and monotonic_counter > expected:
+            self._record_gap(monotonic_counter - expected, macro_time)
+
+    def _record_gap(self, missing, macro_time):
+        self.lost_events += missing
+        self.counter_gaps += 1
+        self.gaps.append((macro_time, missing))
+        if self.metrics is not None:
+            self.metrics.inc('lost_events', missing)
+            self.metrics.inc('counter_gaps')
+
+    # feed already vectorized events (simulator, replay) bypassing the per-photon path
+    def push_chunk(self, channel, time_bin, micro_time, monotonic_counter, macro_time):
+        self.flush()
+        time_bin = np.asarray(time_bin)
+        monotonic_counter = np.asarray(monotonic_counter)
+        chunk = {
+            'channel': np.asarray(channel),
+            'time_bin': time_bin,
+            'micro_time': np.asarray(micro_time),
+            'monotonic_counter': monotonic_counter,
+            'macro_time': np.asarray(macro_time),
+        }
+        if self.counter_is_index and len(monotonic_counter):
+            first = monotonic_counter[0] if self._next_counter is None else self._next_counter
+            missing = np.diff(monotonic_counter, prepend=first - 1) - 1
+            for i in np.flatnonzero(missing > 0):
+                self._record_gap(int(missing[i]), chunk['macro_time'][i])
+            self._next_counter = monotonic_counter[-1] + 1
+        self._fold(chunk)
+
+    # returns once the photons buffered and queued so far are folded
+    def flush(self):
+        with self._lock:
+            self._claimed = True
+            try:
+                # a push in progress either ends or sees the claim
+                while self._pushing:
+                    time.sleep(0)
+                self._hand_off(wait=True)
+            finally:
+                self._claimed = False
+        self._ready.join()
+
+    # queues the chunk being filled; with no free buffer the overflow policy applies, unless wait
+    def _hand_off(self, wait=False):
+        n = self._n
+        self._deadline = time.perf_counter() + self.flush_interval
+        if n == 0:
+            return
+        try:
+            buffer = self._free.get_nowait()
+        except queue.Empty:
+            if not wait and self.overflow == 'decimate' and self.decimation < MAX_DECIMATION:
+                self._decimate()
+                return
+            if not wait and self.overflow != 'block':
+                # the newest chunk is dropped and its buffer filled again
+                self._n = 0
+                self.overflow_dropped += n
+                if self.metrics is not None:
+                    self.metrics.inc('overflow_dropped', n)
+                return
+            start = time.perf_counter()
+            buffer = self._free.get()
+            if self.metrics is not None:
+                self.metrics.observe('blocked', time.perf_counter() - start)
+        chunk = {name: values[:n] for name, values in self._buffer.items()}
+        chunk['scale'] = self.decimation
+        self._ready.put((self._buffer, chunk))
+        self._set_buffer(buffer)
+        self._n = 0
+        depth = self._ready.qsize()
+        if self.decimation > 1 and depth <= self.queue_chunks // 4:
+            self.decimation //= 2
+            self._skip = min(self._skip, self.decimation - 1)
+        if self.metrics is not None:
+            self.metrics.set('queue_depth', depth)
+            self.metrics.set('decimation', self.decimation)
+
+    # every other photon of the chunk being filled is dropped: the kept ones, and the ones
+    # kept from now on, each stand for twice as many photons
+    def _decimate(self):
+        n = self._n
+        kept = (n + 1) // 2
+        for values in self._buffer.values():
+            values[:kept] = values[:n:2]
+        self._n = kept
+        self.decimation *= 2
+        self.decimated_events += n - kept
+        if self.metrics is not None:
+            self.metrics.set('decimation', self.decimation)
+
+    # called by the fold thread when no chunk is queued: picks up the tail of an acquisition that
+    # the API stopped on its own, when no photon arrives to trigger the deadline. A push holding
+    # the chunk means photons still arrive, so the fold thread does not wait for it
+    def _flush_idle(self):
+        if not self._n or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._claimed = True
+            if (not self._pushing and self._n
+                    and time.perf_counter() - self._last_push > 2 * self.flush_interval):
+                # nothing is queued, so every buffer of the pool is free
+                self._hand_off(wait=True)
+        finally:
+            self._claimed = False
+            self._lock.release()
+
+    # seconds since the last photon was pushed
+    def idle_time(self):
+        return time.perf_counter() - self._last_push
+
+    # events of the acquisition missing from the histograms or only counted through the rescale
+    def losses(self):
+        return {'lost': self.lost_events, 'gaps': self.counter_gaps, 'overflow_dropped': self.overflow_dropped,
+                'decimated': self.decimated_events, 'decimation': self.decimation}
+
+    # stops the fold thread once the queued chunks are folded
+    def close(self):
+        if self._thread.is_alive():
+            self.flush()
+            self._ready.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._ready.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_idle()
+                continue
+            if item is None:
+                self._ready.task_done()
+                break
+            buffer, chunk = item
+            try:
+                self._fold(chunk)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._free.put(buffer)
+                self._ready.task_done()
+
+    def _fold(self, chunk):
+        n = len(chunk['time_bin'])
+        if n == 0:
+            return
+        metrics = self.metrics
+        scale = chunk.get('scale', 1)
+        start = time.perf_counter()
+        counts = self.histogram(chunk)
+        self.sink(counts, chunk)
+        if metrics is not None:
+            metrics.observe('fold', time.perf_counter() - start)
+            metrics.inc('events', n * scale)
+            metrics.inc('events_dropped', n * scale - int(counts.sum()))
+            metrics.set('buffer_depth', n)
+
+        self.total_photons += n * scale
+        self._rate_photons += n * scale
+        now = time.perf_counter()
+        elapsed = now - self._rate_start
+        if elapsed >= 1.0:
+            self.photons_per_second = self._rate_photons / elapsed
+            self.peak_photons_per_second = max(self.peak_photons_per_second, self.photons_per_second)
+            self._rate_start = now
+            self._rate_photons = 0
@@ -0,0 +1,216 @@
+import os
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+
+
+# components of the per-batch fits, the phasor history has a tau and amplitude column for each
+MAX_COMPONENTS = 3
+
+# lifetimes (ns, increasing) and amplitudes of the exponential components as fractions of the
+# photons (the convention of SimulatedFlimLabsApi), background (counts per bin), reduced
+# chi-square and number of Levenberg-Marquardt iterations of a fit
+FitResult = namedtuple('FitResult', ['taus', 'amplitudes', 'background', 'chi2', 'iterations'])
+
+
+def initial_taus(components):
+    return (2.5,) if components == 1 else tuple(np.geomspace(0.5, 5, components))
+
+
+# (components, bins) probability that a photon emitted in a bin is detected m bins later, for
+# exponential decays repeated every laser period; exact for emission times uniform in the bin
+def exponential_kernels(taus, period_ns, bins):
+    r = np.asarray(taus, dtype=np.float64)[:, None] / (period_ns / bins)
+    q = np.exp(-1 / r)
+    wrap = 1 - q ** bins
+    m = np.arange(bins)
+    kernels = r * (1 - q) ** 2 * q ** np.maximum(m - 1, 0) / wrap
+    kernels[:, 0] = 1 - r[:, 0] * (1 - q[:, 0]) + r[:, 0] * (1 - q[:, 0]) ** 2 * q[:, 0] ** (bins - 1) / wrap[:, 0]
+    return kernels
+
+
+# (components, bins) unit-area shapes of the exponential components as seen through the
+# instrument. With tau_reference=0 the reference is the IRF itself; otherwise it is the decay
+# of a reference fluorophore of that lifetime and the components follow the reference
+# convolution method, tau_reference / tau * reference + (1 - tau_reference / tau) * reference (x)
+# kernel, which unlike a deconvolution of the reference does not amplify its noise
+def decay_components(taus, reference, period_ns, tau_reference=0):
+    bins = reference.shape[-1]
+    reference = reference / reference.sum()
+    kernels = exponential_kernels(taus, period_ns, bins)
+    convolved = np.fft.irfft(np.fft.rfft(reference) * np.fft.rfft(kernels, axis=-1), n=bins, axis=-1)
+    if not tau_reference:
+        return convolved
+    ratio = tau_reference / np.asarray(taus, dtype=np.float64)[:, None]
+    return ratio * reference + (1 - ratio) * convolved
+
+
+# weighted least squares of the linear amplitudes, dropping negative ones
+def _amplitudes(columns, y, weights):
+    design = columns.T * weights[:, None]
+    target = y * weights
+    active = np.arange(columns.shape[0])
+    coefficients = np.zeros(columns.shape[0])
+    while len(active):
+        solution = np.linalg.lstsq(design[:, active], target, rcond=None)[0]
+        if (solution >= 0).all():
+            coefficients[active] = solution
+            break
+        active = np.delete(active, np.argmin(solution))
+    return coefficients
+
+
+class _Problem:
+    # variable projection: the residual depends on the log lifetimes only, the amplitudes
+    # are solved linearly for every evaluation
+    def __init__(self, histogram, reference, period_ns, tau_reference, background):
+        self.y = np.asarray(histogram, dtype=np.float64)
+        self.reference = np.asarray(reference, dtype=np.float64)
+        self.period_ns = period_ns
+        self.tau_reference = tau_reference
+        self.background = background
+        # Neyman weights: 1 / sigma with sigma^2 = counts, at least one count; the noise of the
+        # reference is not accounted for, chi2 grows when it has few photons
+        self.weights = 1 / np.sqrt(np.maximum(self.y, 1))
+
+    def columns(self, log_taus):
+        columns = decay_components(np.exp(log_taus), self.reference, self.period_ns, self.tau_reference)
+        if self.background:
+            columns = np.vstack((columns, np.ones(len(self.y))))
+        return columns
+
+    def residual(self, log_taus):
+        columns = self.columns(log_taus)
+        coefficients = _amplitudes(columns, self.y, self.weights)
+        return (self.y - coefficients @ columns) * self.weights, coefficients
+
+
+def fit_decay(histogram, reference, period_ns, taus=(2.5,), tau_reference=0, background=True, max_iterations=100,
+              tolerance=1e-8):
+    problem = _Problem(histogram, reference, period_ns, tau_reference, background)
+    bins = len(problem.y)
+    # lifetimes are kept between a tenth of a bin and ten laser periods
+    bounds = np.log(period_ns / bins / 10), np.log(10 * period_ns)
+    log_taus = np.clip(np.log(np.asarray(taus, dtype=np.float64)), *bounds)
+    residual, coefficients = problem.residual(log_taus)
+    cost = residual @ residual
+    damping = 1e-3
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        # forward difference jacobian of the projected residual
+        step = 1e-6 * np.maximum(1, np.abs(log_taus))
+        jacobian = np.empty((bins, len(log_taus)))
+        for k in range(len(log_taus)):
+            shifted = log_taus.copy()
+            shifted[k] += step[k]
+            jacobian[:, k] = (problem.residual(shifted)[0] - residual) / step[k]
+        gradient = jacobian.T @ residual
+        hessian = jacobian.T @ jacobian
+        while damping < 1e10:
+            delta = np.linalg.solve(hessian + damping * np.diag(np.diag(hessian) + 1e-12), -gradient)
+            candidate = np.clip(log_taus + delta, *bounds)
+            candidate_residual, candidate_coefficients = problem.residual(candidate)
+            candidate_cost = candidate_residual @ candidate_residual
+            if candidate_cost < cost:
+                break
+            damping *= 10
+        else:
+            break
+        converged = cost - candidate_cost <= tolerance * cost
+        log_taus, residual, coefficients, cost = candidate, candidate_residual, candidate_coefficients, candidate_cost
+        damping = max(damping / 10, 1e-12)
+        if converged:
+            break
+
+    components = len(log_taus)
+    order = np.argsort(log_taus)
+    amplitudes = coefficients[:components][order]
+    total = amplitudes.sum()
+    parameters = 2 * components + background
+    return FitResult(np.exp(log_taus)[order], amplitudes / total if total > 0 else amplitudes,
+                     coefficients[components] if background else 0.0, cost / max(bins - parameters, 1), iteration)
+
+
+def empty_fit(components):
+    return FitResult(np.full(components, np.nan), np.full(components, np.nan), np.nan, np.nan, 0)
+
+
+# one task of the pool: the (channels, bins) histograms of a batch against the (channels, bins) references
+def fit_batch(histograms, references, period_ns, taus, tau_reference=0):
+    results = []
+    for histogram, reference in zip(histograms, references):
+        if histogram.sum() == 0 or reference.sum() == 0:
+            results.append(empty_fit(len(taus)))
+        else:
+            results.append(fit_decay(histogram, reference, period_ns, taus, tau_reference))
+    return results
+
+
+class LifetimeFitter:
+    """Multi-exponential least-squares fits of the batch decays on a pool of
+    worker processes, one per core by default.
+
+    Every closed batch is one task: its histograms go to the pool with the
+    calibration reference used as IRF, so fitting never runs on the Qt thread
+    and keeps up with short batches as long as there are cores. Results come
+    back in completion order as (key, [FitResult per channel]) in `results`,
+    for the GUI to poll. The pool is only started with the first fit and is
+    kept for the session: discard() drops the fits submitted so far, and
+    their results, without respawning the workers.
+    """
+
+    def __init__(self, components=2, workers=None):
+        self.components = components
+        self.workers = workers or os.cpu_count() or 1
+        self.results = deque()
+        self.errors = []
+        self.pending = 0
+        # results of fits submitted before the last discard() are dropped
+        self.generation = 0
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def submit(self, key, histograms, references, period_ns, tau_reference=0):
+        if self._pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn: workers do not inherit the Qt process
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        future = self._pool.submit(fit_batch, np.array(histograms, dtype=np.float64),
+                                   np.array(references, dtype=np.float64), period_ns,
+                                   initial_taus(self.components), tau_reference)
+        with self._lock:
+            self.pending += 1
+            self._futures.add(future)
+            generation = self.generation
+        future.add_done_callback(lambda future: self._done(key, generation, future))
+
+    def _done(self, key, generation, future):
+        with self._lock:
+            self.pending -= 1
+            self._futures.discard(future)
+            if future.cancelled() or generation != self.generation:
+                return
+            try:
+                self.results.append((key, future.result()))
+            except Exception as e:
+                self.errors.append((key, e))
+
+    # drops the fits submitted so far: the queued ones are cancelled, the results of the running
+    # ones and the ones not polled yet are discarded. The pool keeps running
+    def discard(self):
+        with self._lock:
+            self.generation += 1
+            futures, self._futures = self._futures, set()
+            self.results.clear()
+        for future in futures:
+            future.cancel()
+
+    # fits still queued are dropped, the running ones are not waited for
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
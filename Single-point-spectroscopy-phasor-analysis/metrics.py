@@ -0,0 +1,169 @@
+import bisect
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# upper bounds (seconds) of the latency buckets, log spaced from 1 us to 10 s
+LATENCY_BUCKETS = tuple(float(f'{bound:.3g}') for bound in np.logspace(-6, 1, 22))
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram: observe is O(log buckets) and keeps no samples."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # upper bound of the bucket holding the q quantile (0..1), clamped to the last bucket
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return self.buckets[min(i, len(self.buckets) - 1)]
+
+    def cumulative(self):
+        return np.cumsum(self.counts).tolist()
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of the acquisition and GUI hot paths.
+
+    Each metric is written by a single thread (the acquisition thread for the
+    ingestion metrics, the GUI or a writer thread for the others), so nothing
+    is locked on the hot path. Sources are functions called at snapshot time,
+    for buffer depths and for the metrics of another process. snapshot()
+    also turns every counter into a rate per second since the last snapshot.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sources = {}
+        self._last_counters = {}
+        self._last_time = time.perf_counter()
+
+    def inc(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # source() returns a number, or a dict of numbers whose keys get `name_` as prefix
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    def snapshot(self):
+        now = time.perf_counter()
+        elapsed = max(now - self._last_time, 1e-9)
+        counters = dict(self.counters)
+        rates = {name: (value - self._last_counters.get(name, 0)) / elapsed for name, value in counters.items()}
+        self._last_counters, self._last_time = counters, now
+        gauges = dict(self.gauges)
+        for name, source in list(self.sources.items()):
+            value = source()
+            if isinstance(value, dict):
+                gauges.update({f'{name}_{key}': item for key, item in value.items()})
+            elif value is not None:
+                gauges[name] = value
+        latency = {name: {'count': histogram.count, 'sum': histogram.sum, 'p50': histogram.quantile(0.5),
+                          'p99': histogram.quantile(0.99), 'buckets': histogram.cumulative()}
+                   for name, histogram in list(self.histograms.items())}
+        return {'time': time.time(), 'counters': counters, 'rates': rates, 'gauges': gauges, 'latency': latency}
+
+
+# flat {name: value} view of a snapshot, e.g. to send the metrics of one process to another
+def flatten(snapshot):
+    values = dict(snapshot['gauges'])
+    values.update({f'{name}_total': value for name, value in snapshot['counters'].items()})
+    values.update({f'{name}_per_s': value for name, value in snapshot['rates'].items()})
+    for name, latency in snapshot['latency'].items():
+        values[f'{name}_p50_s'] = latency['p50']
+        values[f'{name}_p99_s'] = latency['p99']
+    return values
+
+
+def prometheus_text(snapshot, prefix='phasor'):
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+    for name, value in sorted(snapshot['rates'].items()):
+        lines += [f'# TYPE {prefix}_{name}_per_second gauge', f'{prefix}_{name}_per_second {value:.6g}']
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines += [f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value:.6g}']
+    for name, latency in sorted(snapshot['latency'].items()):
+        metric = f'{prefix}_{name}_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), latency['buckets']):
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+        lines += [f'{metric}_sum {latency["sum"]:.6g}', f'{metric}_count {latency["count"]}']
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsWriter:
+    """Writes metric snapshots to a local file that can be scraped.
+
+    With fmt='jsonl' every snapshot is one JSON line appended to path (bucket
+    counts left out); the file is rotated at max_bytes, keeping `backups` old
+    files as path.1, path.2, ... With fmt='prometheus' path holds the text
+    exposition format of the last snapshot, replaced atomically at every write
+    (e.g. for the node_exporter textfile collector).
+    """
+
+    def __init__(self, path='metrics.jsonl', fmt='jsonl', max_bytes=1 << 20, backups=3):
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError(f'unknown metrics format {fmt!r}')
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, snapshot):
+        if self.fmt == 'prometheus':
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                f.write(prometheus_text(snapshot))
+            os.replace(temporary, self.path)
+            return
+        latency = {name: {key: value for key, value in entry.items() if key != 'buckets'}
+                   for name, entry in snapshot['latency'].items()}
+        line = json.dumps({**snapshot, 'latency': latency}) + '\n'
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
@@ -1,17 +1,30 @@
 import sys
-import math
+import argparse
+import time
+from collections import deque
 import matplotlib
-import pandas as pd
-import matplotlib.pyplot as plt
-from PyQt5.QtCore import QTimer, QMutex, Qt
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QSpinBox, QFileDialog, QSplitter, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout,QDoubleSpinBox
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QSpinBox, QFileDialog, QSplitter, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout,QDoubleSpinBox,QCheckBox,QComboBox,QProgressBar
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 matplotlib.use('Qt5Agg')
 import numpy as np
 from numpy import linspace
 
-from flim_labs_api import FlimLabsApi
+from ingestion import MacroTimeBatcher, PhotonIngestor, default_bin_offset
+from histogram_store import HistogramStore
+from phasor_engine import PhasorEngine
+from renderer import CanvasRenderer, PhasorDensity, universal_semicircle
+from scheduler import FrameScheduler
+from recorder import EventRecorder
+from batch_store import BatchRecorder
+from phasor_history import PhasorHistory
+from slice_history import SliceHistory
+from calibration_cache import CalibrationCache
+from lifetime_fit import MAX_COMPONENTS, LifetimeFitter
+from metrics import Metrics, MetricsWriter, flatten
+from exporter import BackgroundExporter, available_formats, default_format
+from simulator import SimulatedFlimLabsApi
 
 class MplCanvas(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100, title='', nrows=1, ncols=1):
@@ -26,40 +39,51 @@ class MplCanvas(FigureCanvas):
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, simulate=False, bins=256, channels=(1,), process=False, metrics_format='jsonl',
+                 overflow='block', counter_is_index=False, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
+        # counters, gauges and latencies of the hot paths, shown in the status panel and written
+        # every metrics_interval seconds to metrics.jsonl (rotated) or metrics.prom
+        self.metrics = Metrics()
+        self.metrics_interval = 1.0
+        self.metrics_writer = MetricsWriter('metrics.prom' if metrics_format == 'prometheus' else 'metrics.jsonl',
+                                            metrics_format)
+        self.last_metrics_time = 0.0
+
         self.laser_mhz = 40
         self.laser_period_in_nanoseconds = 1000 / self.laser_mhz
         self.acquisition_time_in_seconds_ref = 20
         self.acquisition_time_in_seconds_data = 20
         self.refresh_time_seconds = 5
         self.harmonic_value =  1
+        # harmonics 1..harmonics are computed together and shown side by side
+        self.harmonics = 2
         self.tau_phase_reference = 4
         self.tau_modulation_reference = 4 
-        self.k = 1 / (2*np.pi*self.harmonic_value*self.laser_mhz*1e6)
-        self.m = np.sqrt(1 / (1 + ((self.tau_modulation_reference*1e-9/self.k)**2)))    
-        self.phi = math.atan2(self.tau_modulation_reference*1e-9,self.k)
+        # time bins per laser period; histograms, phasor basis and bin offset all follow it
+        self.bins = bins
+        self.bin_offset = self.bin_offset_for(self.bins)
+        # acquired channels: every histogram is a (channels, bins) array and every phasor
+        # is computed for all the channels at once; channel_view is the one shown in the labels
+        self.channels = tuple(channels)
+        self.channel_view = 0
         
                 
-        self.y_data_ref = np.ones(256)        
-        self.x_data = linspace(0, 1000 / self.laser_mhz, 256)
-        self.y_data = np.ones(256)
-        self.y_data_upd = np.ones(256)
-        
-        
-        ## TO BE VERIFIED
-        self.sine_reference = np.sin(2*np.pi*self.harmonic_value*self.x_data / self.laser_period_in_nanoseconds) ## AR
-        self.cosine_reference = np.cos(2*np.pi*self.harmonic_value*self.x_data / self.laser_period_in_nanoseconds) ## AR
-        #self.sine_reference = np.sin(2*np.pi*self.harmonic_value*self.x_data / 256) 
-        #self.cosine_reference = np.cos(2*np.pi*self.harmonic_value*self.x_data / 256) 
-        self.s_reference = (self.sine_reference*self.y_data_ref).sum()/self.y_data_ref.sum() 
-        self.g_reference = (self.cosine_reference*self.y_data_ref).sum()/self.y_data_ref.sum() 
-        
-        self.phi_reference = math.atan2(self.s_reference,self.g_reference)
-        self.m_reference = np.sqrt(self.g_reference**2+self.s_reference**2)
-        self.phi_instr = self.phi_reference - self.phi
-        self.m_instr = self.m_reference/self.m 
+        # reference histograms and calibrations of previous sessions, per laser frequency,
+        # harmonic, bins, bin offset, reference lifetimes and channels
+        self.calibrations = CalibrationCache('calibration_cache.json')
+        self.y_data_ref = self.cached_reference()        
+        self.x_data = linspace(0, 1000 / self.laser_mhz, self.bins)
+        self.y_data = np.ones((len(self.channels), self.bins))
+        self.y_data_upd = np.ones((len(self.channels), self.bins))
+        
+        # all the phasor math (reference basis, calibration, lifetimes) lives in the engine
+        self.engine = PhasorEngine(laser_mhz=self.laser_mhz, bins=self.bins, harmonic=self.harmonic_value,
+                                   tau_phase_reference=self.tau_phase_reference,
+                                   tau_modulation_reference=self.tau_modulation_reference,
+                                   harmonics=self.harmonics)
+        self.engine.calibrate(self.y_data_ref)
         
         self.setGeometry(512, 512, 1920, 1080)
         self.setWindowTitle('Phasor analysis ')
@@ -70,8 +94,64 @@ class MainWindow(QMainWindow):
          #  self.api = FlimLabsApi()
           # self.api.set_consumer_handler(self.receive_measure)
         #else:
-        self.api = FlimLabsApi()
-        self.api.set_consumer_handler(self.receive_point)
+        # data batches are cut on the photon macro times by the acquisition thread; the
+        # snapshots at the batch boundaries are queued for the GUI to record
+        self.closed_batches = deque()
+        # laser frequency measures, queued by the API (or process listener) thread and shown by a poller
+        self.measured_frequencies = deque()
+        self.measuring_frequency = False
+        # the data acquisition is also kept as prefix sums of 100 ms slices: the batch phasors of
+        # any window length and step are recomputed from them once the acquisition is over
+        self.slices = SliceHistory(len(self.channels), self.bins)
+        self.window_step_seconds = None
+        self.ref_baseline = None
+        self.data_baseline = None
+        self.batch_baseline = None
+        if process:
+            # with process=True acquisition, ingestion and accumulation run in a separate process
+            # that writes the histograms to shared memory; the GUI maps them and reads snapshots
+            from acquisition_process import AcquisitionProcess
+            self.acquisition = AcquisitionProcess(('reference', 'data'), bins=self.bins, bin_offset=self.bin_offset,
+                                                  basis=self.engine.basis, channels=self.channels,
+                                                  batch_seconds=self.refresh_time_seconds, simulate=simulate,
+                                                  batches=self.closed_batches, overflow=overflow,
+                                                  slices=self.slices, frequencies=self.measured_frequencies,
+                                                  counter_is_index=counter_is_index)
+            self.histograms = self.acquisition.histograms
+            self.ingestor = self.api = self.batcher = None
+        else:
+            self.acquisition = None
+            # the store owns the histograms: the acquisition thread writes, the GUI reads snapshots;
+            # running phasor sums of the histograms are kept in the engine basis
+            self.histograms = HistogramStore(('reference', 'data'), bins=self.bins, basis=self.engine.basis,
+                                             channels=len(self.channels), metrics=self.metrics)
+            # photons are buffered by the ingestor and folded into the histograms in chunks by its fold
+            # thread; when folding falls behind, `overflow` blocks, drops or decimates the new photons.
+            # Lost events are only counted when the firmware counter numbers the events (counter_is_index)
+            self.ingestor = PhotonIngestor(self.receive_chunk, bins=self.bins, bin_offset=self.bin_offset,
+                                           chunk_size=65536, flush_interval=0.05, channels=self.channels,
+                                           metrics=self.metrics, overflow=overflow,
+                                           counter_is_index=counter_is_index)
+            # with simulate=True photons come from a simulated source instead of the acquisition card;
+            # the card API (and its zmq and psutil imports) is only loaded when it is used
+            if simulate:
+                self.api = SimulatedFlimLabsApi(bins=self.bins, bin_offset=self.bin_offset, channels=self.channels,
+                                                counter_is_index=counter_is_index)
+            else:
+                from flim_labs_api import FlimLabsApi
+                self.api = FlimLabsApi()
+            self.api.set_consumer_handler(self.ingestor.push)
+            self.batcher = MacroTimeBatcher(self.refresh_time_seconds)
+        self.firmware = "firmwares\\spectroscopy_40MHz.flim"
+        
+        # optional recorder of the raw photon events, active while an acquisition runs
+        self.recorder = None
+        # binary file of the data batches (histogram, boundaries and phasor of every batch)
+        self.batch_recorder = None
+        self.batch_start_ns = 0.0
+        # exports are written by a worker thread, the GUI only queues them
+        self.exporter = BackgroundExporter(self.metrics)
+        self.export_format = default_format()
         
         
         self.acquiring_ref = False
@@ -80,17 +160,20 @@ class MainWindow(QMainWindow):
         
         self.tau_life = 3.134 
         
-        #list for g and s points to be plotted all together in canvas3.ax2
-        self.g_data_referenced_list = []
-        self.s_data_referenced_list = []
+        # per-batch results (boundaries, photons, g, s, m, phi and the lifetime fit) in one columnar
+        # store; the last phasor_window batches are kept in memory
+        self.phasor_window = 10000
+        self.fit_columns = ([f'tau_{k}' for k in range(1, MAX_COMPONENTS + 1)]
+                            + [f'a_{k}' for k in range(1, MAX_COMPONENTS + 1)] + ['chi2'])
+        self.phasor_history = PhasorHistory(('channel', 'start_ns', 'end_ns', 'photons', 'g', 's', 'm', 'phi',
+                                             *self.fit_columns), window=self.phasor_window)
+        # multi-exponential fits of the batch decays run on a process pool, the results fill
+        # the fit columns of the history as they come back
+        self.fitter = LifetimeFitter(components=2)
         
         # Initialize lists to store acquired data
         #self.x_data_list = []
         #self.y_data_list = []
-        self.g_data_excel_list = []
-        self.s_data_excel_list = []
-        self.m_fluo_list = []
-        self.phi_fluo_list = []
         
         #initialize the counter for the batches of data in canvas2.ax2
         self.batch_counter = 0
@@ -98,53 +181,77 @@ class MainWindow(QMainWindow):
         
 
 
-        # Create three MplCanvas objects
+        # Create three MplCanvas objects; the axes are set up once and every refresh
+        # only updates the data of persistent artists (blitted when self.blitting is True)
+        self.blitting = True
         self.canvas1 = MplCanvas(self, width=5, height=4, dpi=100, nrows=1, ncols=2)  
         self.canvas1.ax1 = self.canvas1.axes[0]
         self.canvas1.ax1.set_visible(False)        
         self.canvas1.ax2 = self.canvas1.axes[1]
-        self.canvas1.ax2.plot(self.x_data, self.y_data_ref) 
+        self.canvas1.ax2.set_xlim([0, 1000 / self.laser_mhz])
         self.canvas1.ax2.set_title('TCSPC calibration sample')        
+        self.canvas1.ax2.set_xlabel('Time (ns)')
         self.canvas1.ax2.set_ylabel('Counts')
         self.canvas1.setFixedSize(1920, 330)
+        self.renderer1 = CanvasRenderer(self.canvas1, blit=self.blitting, metrics=self.metrics, name='canvas1')
+        # one line per channel in every histogram plot
+        self.lines_ref = self.canvas1.ax2.plot(self.x_data, self.y_data_ref.T)
+        for line in self.lines_ref:
+            self.renderer1.add_artist(line)
                 
         self.canvas2 = MplCanvas(self, width=5, height=4, dpi=100, nrows=1, ncols=2)
         self.canvas2.ax1 = self.canvas2.axes[0]
-        self.canvas2.ax1.plot(self.x_data, self.y_data)
-        self.canvas2.ax1.set_title('TCSPC data sample')
+        self.canvas2.ax1.set_xlim([0, 1000 / self.laser_mhz])
+        self.canvas2.ax1.set_title('Global decay histogram')
+        self.canvas2.ax1.set_xlabel('Time (ns)')
+        self.canvas2.ax1.set_ylabel('Counts')
         self.canvas2.ax2 = self.canvas2.axes[1]
-        self.canvas2.ax2.plot(self.x_data, self.y_data_upd)
-        self.canvas2.ax2.set_title('TCSPC data sample')
+        self.canvas2.ax2.set_xlim([0, 1000 / self.laser_mhz])
+        self.canvas2.ax2.set_title(f'{self.refresh_time_seconds:g} seconds TCSPC data sample')
+        self.canvas2.ax2.set_xlabel('Time (ns)')
+        self.canvas2.ax2.set_ylabel('Counts')
         self.canvas2.setFixedSize(1920, 330)
+        self.renderer2 = CanvasRenderer(self.canvas2, blit=self.blitting, metrics=self.metrics, name='canvas2')
+        self.lines_data = self.canvas2.ax1.plot(self.x_data, self.y_data.T)
+        self.lines_data_upd = self.canvas2.ax2.plot(self.x_data, self.y_data_upd.T)
+        for line in self.lines_data + self.lines_data_upd:
+            self.renderer2.add_artist(line)
+        if len(self.channels) > 1:
+            for line, channel in zip(self.lines_ref, self.channels):
+                line.set_label(f'channel {channel}')
+            self.canvas1.ax2.legend(loc='upper right')
 
         self.canvas3 = MplCanvas(self, width=5, height=4, dpi=100, nrows = 1, ncols = 2)
         self.canvas3.ax1 = self.canvas3.axes[0]
-        #self.canvas3.ax1 = self.canvas3.figure.add_axes([0.1, 0.3, 0.35, self.subplot_height])
-        self.canvas3.ax1.plot(self.x_data, self.y_data)
-        self.canvas3.ax1.set_xlabel('G')
-        self.canvas3.ax1.set_ylabel('S')
-        self.canvas3.ax1.set_xlim([-0.005,1.2])
-        self.canvas3.ax1.set_ylim([0, 0.6])
-        self.canvas3.ax1.set_title('Global phasor plot')
-        self.x_circle = np.linspace(-1.0, 1.0, 100)
-        self.y_circle = np.linspace(-1.0, 1.0, 100)
-        self.X, self.Y = np.meshgrid(self.x_circle,self.y_circle)
-        self.F = (self.X**2 + self.Y**2 - self.X)
-        self.canvas3.ax1.contour(self.X,self.Y,self.F,[0],colors='b',linewidths=3)
         self.canvas3.ax2 = self.canvas3.axes[1]
-        #self.canvas3.ax2 = self.canvas3.figure.add_axes([0.55, 0.3, 0.35, self.subplot_height])
-        self.canvas3.ax2.plot(self.x_data, self.y_data)
-        self.canvas3.ax2.set_xlabel('G')
-        self.canvas3.ax2.set_ylabel('S')
-        self.canvas3.ax2.set_xlim([-0.005,1.2])
-        self.canvas3.ax2.set_ylim([0, 0.6])
-        self.canvas3.ax2.set_title('Global phasor plot')
-        self.x_circle_2 = np.linspace(-1.0, 1.0, 100)
-        self.y_circle_2 = np.linspace(-1.0, 1.0, 100)
-        self.X_2, self.Y_2 = np.meshgrid(self.x_circle_2,self.y_circle_2)
-        self.F_2 = (self.X_2**2 + self.Y_2**2 - self.X_2)        
-        self.canvas3.ax2.contour(self.X_2,self.Y_2,self.F_2,[0],colors='b',linewidths=3)
+        self.canvas3.ax1.set_title('Global phasor plot')
+        self.canvas3.ax2.set_title(f'{self.refresh_time_seconds:g} seconds Refreshed phasor plot')
+        g_circle, s_circle = universal_semicircle()
+        for ax in (self.canvas3.ax1, self.canvas3.ax2):
+            ax.set_xlabel('g')
+            ax.set_ylabel('s')
+            ax.set_xlim([-0.005,1.2])
+            ax.set_ylim([0, 0.6])
+        # the universal semicircle is part of the static background of the global plot, drawn once
+        self.canvas3.ax1.plot(g_circle, s_circle, color='b', linewidth=3)
         self.canvas3.setFixedSize(1920, 330)
+        self.renderer3 = CanvasRenderer(self.canvas3, blit=self.blitting, metrics=self.metrics, name='canvas3')
+        # one global phasor point per channel, in the color of its histogram lines
+        self.global_points = [self.canvas3.ax1.plot([], [], 'o', color=line.get_color())[0]
+                              for line in self.lines_ref]
+        for point in self.global_points:
+            self.renderer3.add_artist(point)
+        # the batch phasors of every channel are binned into a density map; the one of the
+        # viewed channel is drawn as an image with the semicircle on top of it
+        self.phasor_densities = [PhasorDensity(extent=(-0.005, 1.2, 0, 0.6), shape=(120, 240))
+                                 for _ in self.channels]
+        self.phasor_density = self.phasor_densities[self.channel_view]
+        self.density_image = self.canvas3.ax2.imshow(self.phasor_density.image(), extent=self.phasor_density.extent,
+                                                     origin='lower', aspect='auto', cmap='YlOrRd',
+                                                     interpolation='nearest', vmin=0, vmax=1)
+        self.batch_circle, = self.canvas3.ax2.plot(g_circle, s_circle, color='b', linewidth=3)
+        self.renderer3.add_artist(self.density_image)
+        self.renderer3.add_artist(self.batch_circle)
         
         # Create a vertical layout and add the three canvas widgets to it
         layout = QVBoxLayout()
@@ -177,8 +284,61 @@ class MainWindow(QMainWindow):
         self.stop_button_data = QPushButton('Stop', self)
         self.stop_button_data.move(120, 330)
         self.stop_button_data.clicked.connect(self.stop_acquisition)
-        self.stop_button_data.clicked.connect(self.save_to_excel)
-        self.mutex = QMutex()
+        self.stop_button_data.clicked.connect(self.save_phasors)
+        
+        # draw a combo box to select the number of time bins, between acquisitions only
+        self.bins_label = QLabel('Time bins:', self)
+        self.bins_label.move(1000, 45)
+        self.bins_label.adjustSize()
+        
+        self.bins_combobox = QComboBox(self)
+        self.bins_combobox.move(1000, 70)
+        self.bins_combobox.addItems(['256', '1024', '4096'])
+        self.bins_combobox.setCurrentText(str(self.bins))
+        self.bins_combobox.currentTextChanged.connect(self.set_bins)
+        
+        # draw a combo box to select the channel shown in the labels and the refreshed phasor plot
+        self.channel_label = QLabel('Channel:', self)
+        self.channel_label.move(1100, 45)
+        self.channel_label.adjustSize()
+        
+        self.channel_combobox = QComboBox(self)
+        self.channel_combobox.move(1100, 70)
+        self.channel_combobox.addItems([str(channel) for channel in self.channels])
+        self.channel_combobox.currentIndexChanged.connect(self.set_channel_view)
+        
+        # draw a check box to record the raw photon events of the next acquisitions
+        self.record_checkbox = QCheckBox('Record raw events', self)
+        self.record_checkbox.move(240, 330)
+        self.record_checkbox.adjustSize()
+        
+        # draw a combo box for the format of the phasor export and its progress bar
+        self.export_combobox = QComboBox(self)
+        self.export_combobox.move(400, 330)
+        self.export_combobox.addItems(available_formats())
+        self.export_combobox.setCurrentText(self.export_format)
+        self.export_combobox.currentTextChanged.connect(self.set_export_format)
+        self.export_progress = QProgressBar(self)
+        self.export_progress.setGeometry(510, 333, 300, 22)
+        self.export_progress.setRange(0, 100)
+        self.export_progress.setFormat('export: idle')
+        
+        # draw a check box and a spin box to fit every batch decay with 1..3 exponentials
+        self.fit_checkbox = QCheckBox('Fit lifetimes', self)
+        self.fit_checkbox.move(830, 330)
+        self.fit_checkbox.adjustSize()
+        self.fit_spinbox = QSpinBox(self)
+        self.fit_spinbox.move(940, 330)
+        self.fit_spinbox.setRange(1, MAX_COMPONENTS)
+        self.fit_spinbox.setValue(self.fitter.components)
+        self.fit_spinbox.valueChanged.connect(self.set_fit_components)
+        
+        # draw a button to export the batch phasors again once the acquisition is over, e.g. after
+        # they were recomputed for another refresh time or window step
+        self.export_button = QPushButton('Export phasors', self)
+        self.export_button.move(1010, 330)
+        self.export_button.setEnabled(False)
+        self.export_button.clicked.connect(self.save_phasors)
         
         
         # create a label and spin box for laser frequency setting (sync out)
@@ -248,36 +408,44 @@ class MainWindow(QMainWindow):
         self.refresh_label.move(5, 480)
         self.refresh_label.adjustSize()
         
-        self.refresh_spinbox = QSpinBox(self)
+        self.refresh_spinbox = QDoubleSpinBox(self)
         self.refresh_spinbox.move(5, 505)
-        self.refresh_spinbox.setMinimum(3)
+        self.refresh_spinbox.setMinimum(0.1)
         self.refresh_spinbox.setMaximum(30)
+        self.refresh_spinbox.setSingleStep(0.1)
         self.refresh_spinbox.setValue(self.refresh_time_seconds )
         self.refresh_spinbox.valueChanged.connect(self.set_refresh_time_in_seconds)
         
-        # create timer to refresh histogram of reference
-        self.refresh_timer = QTimer()
-        self.refresh_timer.timeout.connect(self.refresh_histogram_ref)
-        self.refresh_timer.setInterval(100)
-        self.refresh_timer.start()
-        
-        # create timer to refresh histogram of data
-        self.refresh_timer_data = QTimer()
-        self.refresh_timer_data.timeout.connect(self.refresh_histogram)
-        self.refresh_timer_data.setInterval(100)
-        self.refresh_timer_data.start()
-        
-        # create timer to refresh histogram of data refreshed
-        #self.refresh_timer_data_refreshed = QTimer()
-        #self.refresh_timer_data_refreshed.timeout.connect(self.refresh_histogram_refreshed)
-        #self.refresh_timer_data_refreshed.setInterval(100)
-        #self.refresh_timer_data_refreshed.start()
-        
-        # create a timer to update canvas2 with new data every tot seconds 
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.update_canvas2)
-        self.timer.setInterval(self.refresh_time_seconds * 1000)
-        self.timer.start()
+        # create a label and spin box to set the step of the windows recomputed after an acquisition,
+        # 0 for back to back windows of the refresh time
+        self.window_step_label = QLabel('Window step (Seconds, 0 = none):', self)
+        self.window_step_label.move(180, 480)
+        self.window_step_label.adjustSize()
+        
+        self.window_step_spinbox = QDoubleSpinBox(self)
+        self.window_step_spinbox.move(180, 505)
+        self.window_step_spinbox.setMinimum(0)
+        self.window_step_spinbox.setMaximum(30)
+        self.window_step_spinbox.setSingleStep(0.1)
+        self.window_step_spinbox.setValue(0)
+        self.window_step_spinbox.valueChanged.connect(self.set_window_step)
+        
+        self.window_label = QLabel(self)
+        self.window_label.move(300, 508)
+        self.window_label.setText('windows: as acquired')
+        self.window_label.adjustSize()
+        
+        # a single frame scheduler redraws only the views marked dirty: reference histogram,
+        # global histogram and batch histogram + phasor plots
+        self.scheduler = FrameScheduler(self, max_fps=20, metrics=self.metrics)
+        self.scheduler.add_view('reference', self.refresh_histogram_ref)
+        self.scheduler.add_view('data', self.refresh_histogram)
+        self.scheduler.add_view('phasor', self.update_canvas2)
+        self.scheduler.add_poller(self.poll_frame_sources)
+        self.scheduler.add_poller(self.poll_export)
+        self.scheduler.add_poller(self.poll_fits)
+        self.scheduler.add_poller(self.poll_frequency)
+        self.last_snapshot = self.histograms.snapshot()
         
         #draw a panel for harmonic selection in phasor analysis
         self.harmonic_label = QLabel('Harmonic:', self)
@@ -321,31 +489,26 @@ class MainWindow(QMainWindow):
         # create a label to show the phase of expected sample
         self.tau_phase_label_ref = QLabel(self)
         self.tau_phase_label_ref.move(600, 145)
-        self.tau_phase_label_ref.setText('phase =' +str(np.round(self.phi,4)))
+        self.tau_phase_label_ref.setText('phase =' +str(np.round(self.engine.phi,4)))
         self.tau_phase_label_ref.adjustSize()
         
         # create a label to show the modulus of expected sample
         self.tau_modulus_label_ref = QLabel(self)
         self.tau_modulus_label_ref.move(800, 145)
-        self.tau_modulus_label_ref.setText('modulus =' +str(np.round(self.m,4)))
+        self.tau_modulus_label_ref.setText('modulus =' +str(np.round(self.engine.m,4)))
         self.tau_modulus_label_ref.adjustSize()
         
         # create a label to show the modulus of the reference
         self.tau_ref_modulus_label_ref = QLabel(self)
         self.tau_ref_modulus_label_ref.move(200, 245)
-        self.tau_ref_modulus_label_ref.setText('IRF modulus =' +str(np.round(self.m_instr,4)))
+        self.tau_ref_modulus_label_ref.setText('IRF modulus =' +str(np.round(self.engine.m_instr,4)))
         self.tau_ref_modulus_label_ref.adjustSize()
         
         # create a label to show the phase of the reference
         self.tau_ref_phase_label_ref = QLabel(self)
         self.tau_ref_phase_label_ref.move(400, 245)
-        self.tau_ref_phase_label_ref.setText('IRF phase =' +str(np.round(self.phi_instr,4)))
+        self.tau_ref_phase_label_ref.setText('IRF phase =' +str(np.round(self.engine.phi_instr,4)))
         self.tau_ref_phase_label_ref.adjustSize()
-        #create a timer to refresh the phasor plot
-        #self.refresh_timer_phasor = QTimer()
-        #self.refresh_timer_phasor.timeout.connect(self.refresh_phasor_plot)
-        #self.refresh_timer_phasor.setInterval(6000)
-        #self.refresh_timer_phasor.start()
         
         # create a label to show the g value
         self.g_label = QLabel(self)
@@ -373,77 +536,218 @@ class MainWindow(QMainWindow):
         self.tau_life_mod_label.setText('tau_modulation =' +str(np.round(self.tau_life*1e9,3)))
         self.tau_life_mod_label.adjustSize()
         
-        
-        
+        # create a label to show the frame time of the three canvases
+        self.frame_label = QLabel(self)
+        self.frame_label.move(1300, 10)
+        self.frame_label.setText('frame time (ms): -')
+        self.frame_label.adjustSize()
+        
+        # create a status panel with the live metrics
+        self.metrics_label = QLabel(self)
+        self.metrics_label.move(1300, 35)
+        self.metrics_label.setText('metrics: -')
+        self.metrics_label.adjustSize()
+        # buffer depths are read when the metrics are collected
+        self.metrics.add_source('closed_batches', lambda: len(self.closed_batches))
+        self.metrics.add_source('export_pending', lambda: self.exporter.pending)
+        self.metrics.add_source('fits_pending', lambda: self.fitter.pending)
+        self.metrics.add_source('batch_queue', lambda: self.batch_recorder.depth() if self.batch_recorder else 0)
+        self.metrics.add_source('photons_per_second', self.photons_per_second)
+        if self.acquisition is not None:
+            self.metrics.add_source('process', lambda: self.acquisition.metrics)
+        self.scheduler.add_poller(self.poll_metrics)
+        
+        # create a label to show the global g and s of every computed harmonic
+        self.harmonics_label = QLabel(self)
+        self.harmonics_label.move(5, 960)
+        self.harmonics_label.setText('harmonics: -')
+        self.harmonics_label.adjustSize()
+        
+        # create a label to show the lifetime fit of the last fitted batch
+        self.fit_label = QLabel(self)
+        self.fit_label.move(5, 1010)
+        self.fit_label.setText('lifetime fit: -')
+        self.fit_label.adjustSize()
+        
+        self.scheduler.start()
         self.show()
         
     def closeEvent(self, event):
-        np.savetxt('Reference_TCSPC.txt', np.vstack((self.x_data, self.y_data_ref)).T)
-        np.savetxt('Data_TCSPC.txt', np.vstack((self.x_data, self.y_data)).T)
-        self.api.stop_acquisition()
+        # stop the acquisition first, the histograms are then written in the background
+        self.stop_source()
+        self.acquiring_ref = self.acquiring_data = False
+        self.stop_batch_recording()
+        self.scheduler.stop()
+        self.take_snapshot()
+        self.exporter.save_text('Reference_TCSPC.txt', np.vstack((self.x_data, self.y_data_ref)).T)
+        self.exporter.save_text('Data_TCSPC.txt', np.vstack((self.x_data, self.y_data)).T)
+        self.exporter.close()
+        self.phasor_history.close()
+        self.fitter.close()
+        if self.ingestor is not None:
+            self.ingestor.close()
+        if self.acquisition is not None:
+            self.acquisition.close()
         event.accept()
         
     def set_laser_frequency(self, value):
         self.laser_mhz = value  
-        self.x_data = linspace(0, 1000 / self.laser_mhz, 256)
+        self.x_data = linspace(0, 1000 / self.laser_mhz, self.bins)
         self.laser_period_in_nanoseconds = 1000 / self.laser_mhz
+        for ax in (self.canvas1.ax2, self.canvas2.ax1, self.canvas2.ax2):
+            ax.set_xlim([0, self.laser_period_in_nanoseconds])
+        self.renderer1.invalidate()
+        self.renderer2.invalidate()
+        self.scheduler.mark_dirty()
+        self.engine.set_laser_frequency(self.laser_mhz)
+        self.histograms.set_basis(self.engine.basis)
+        self.restore_calibration()
         
     
 
                         
+    @staticmethod
+    def bin_offset_for(bins):
+        return default_bin_offset(bins)
+        
+    def set_bins(self, value):
+        # the histograms restart empty at the new resolution
+        self.bins = int(value)
+        self.bin_offset = self.bin_offset_for(self.bins)
+        if self.acquisition is None:
+            self.ingestor.flush()
+            self.ingestor.bins = self.bins
+            self.ingestor.bin_offset = self.bin_offset
+            if isinstance(self.api, SimulatedFlimLabsApi):
+                self.api.bins = self.bins
+                self.api.bin_offset = self.bin_offset
+        self.x_data = linspace(0, self.laser_period_in_nanoseconds, self.bins)
+        self.y_data_ref = self.cached_reference()
+        self.y_data = np.ones((len(self.channels), self.bins))
+        self.y_data_upd = np.ones((len(self.channels), self.bins))
+        self.slices.set_bins(self.bins)
+        self.engine.set_bins(self.bins)
+        self.engine.calibrate(self.y_data_ref)
+        if self.acquisition is not None:
+            self.histograms = self.acquisition.set_layout(self.bins, self.bin_offset, self.engine.basis)
+        else:
+            self.histograms = HistogramStore(('reference', 'data'), bins=self.bins, basis=self.engine.basis,
+                                             channels=len(self.channels), metrics=self.metrics)
+        self.ref_baseline = self.data_baseline = self.batch_baseline = None
+        self.last_snapshot = self.histograms.snapshot()
+        self.scheduler.mark_dirty()
+        
+    def calibration_key(self):
+        return CalibrationCache.key(self.laser_mhz, self.harmonic_value, self.bins, self.bin_offset,
+                                    self.tau_phase_reference, self.tau_modulation_reference, self.channels)
+        
+    # reference histogram of the current settings from the cache, ones (uncalibrated) if there is none
+    def cached_reference(self):
+        reference = self.calibrations.find(self.calibration_key())
+        if reference is None or reference.shape != (len(self.channels), self.bins):
+            return np.ones((len(self.channels), self.bins))
+        return reference
+        
+    # after a settings change: calibrate on the cached reference that matches the new settings,
+    # unless a reference acquisition is running
+    def restore_calibration(self):
+        if self.acquiring_ref:
+            return
+        self.ref_baseline = None
+        self.y_data_ref = self.cached_reference()
+        self.engine.calibrate(self.y_data_ref)
+        self.scheduler.mark_dirty('reference', 'phasor')
+        
+    def store_calibration(self):
+        self.calibrations.store(self.calibration_key(), self.y_data_ref)
+        
+    def set_channel_view(self, index):
+        self.channel_view = index
+        self.phasor_density = self.phasor_densities[index]
+        self.scheduler.mark_dirty('reference', 'phasor')
+        
+    def set_export_format(self, value):
+        self.export_format = value
+        
+    def set_fit_components(self, value):
+        self.fitter.components = value
+        
     def set_acquisition_time_ref(self, value):
         self.acquisition_time_in_seconds_ref = value
 
     def set_acquisition_time_data(self, value):
         self.acquisition_time_in_seconds_data = value  
-        self.w = linspace(0, self.acquisition_time_in_seconds_data / self.acquisition_time_in_seconds_data, 256) 
+        self.w = linspace(0, self.acquisition_time_in_seconds_data / self.acquisition_time_in_seconds_data, self.bins) 
         
     def set_refresh_time_in_seconds(self, value):
         self.refresh_time_seconds = value
-        self.canvas2.ax2.set_title(f'{self.refresh_time_seconds} seconds TCSPC data sample')
-        self.canvas3.ax2.set_title(f'{self.refresh_time_seconds} seconds Refreshed phasor plot')
+        if self.acquisition is not None:
+            self.acquisition.set_batch_seconds(self.refresh_time_seconds)
+        else:
+            self.batcher.set_batch_seconds(self.refresh_time_seconds)
+        self.canvas2.ax2.set_title(f'{self.refresh_time_seconds:g} seconds TCSPC data sample')
+        self.canvas3.ax2.set_title(f'{self.refresh_time_seconds:g} seconds Refreshed phasor plot')
+        self.renderer2.invalidate()
+        self.renderer3.invalidate()
+        self.scheduler.mark_dirty('phasor')
+        if not self.acquiring_data and self.slices.slices:
+            self.rewindow()
+        
+    def set_window_step(self, value):
+        self.window_step_seconds = value or None
+        if not self.acquiring_data and self.slices.slices:
+            self.rewindow()
 
         
     
     def set_harmonic_value(self, value):
         self.harmonic_value = value
-        self.k = 1/(2*np.pi*self.harmonic_value*self.laser_mhz*1e6)
-        self.phi = math.atan2(self.tau_phase_reference*1e-9,self.k)
-        self.tau_phase_label_ref.setText(f'phase : {self.phi:,}')
-        self.m = np.sqrt(1/(1+((self.tau_modulation_reference*1e-9/self.k)**2)))        
-        self.tau_modulus_label_ref.setText(f'modulus : {self.m:,}')
+        self.engine.set_harmonic(self.harmonic_value)
+        self.histograms.set_basis(self.engine.basis)
+        self.restore_calibration()
+        self.tau_phase_label_ref.setText(f'phase : {self.engine.phi:,}')
+        self.tau_modulus_label_ref.setText(f'modulus : {self.engine.m:,}')
+        self.scheduler.mark_dirty('reference', 'phasor')
         
     def set_tau_phase_reference(self, value):
         self.tau_phase_reference = value 
-        self.phi = math.atan2(self.tau_phase_reference*1e-9,self.k)
-        self.tau_phase_label_ref.setText(f'phase : {self.phi:,}')        
+        self.engine.set_tau_phase_reference(self.tau_phase_reference)
+        self.restore_calibration()
+        self.tau_phase_label_ref.setText(f'phase : {self.engine.phi:,}')        
+        self.scheduler.mark_dirty('reference', 'phasor')
         
     def set_tau_modulus_reference(self, value):
         self.tau_modulation_reference = value   
-        self.m = np.sqrt(1/(1+((self.tau_modulation_reference*1e-9/self.k)**2)))        
-        self.tau_modulus_label_ref.setText(f'modulus : {self.m:,}')
+        self.engine.set_tau_modulation_reference(self.tau_modulation_reference)
+        self.restore_calibration()
+        self.tau_modulus_label_ref.setText(f'modulus : {self.engine.m:,}')
+        self.scheduler.mark_dirty('reference', 'phasor')
         
     def start_acquisition(self):
         sender = self.sender()
         if sender == self.start_button_ref:
             self.start_button_ref.setEnabled(False)
+            self.bins_combobox.setEnabled(False)
             self.acquiring_ref = True
-            self.y_data_ref = np.zeros(256)
-            self.api.set_firmware("firmwares\\spectroscopy_40MHz.flim")
-            self.api.acquire_spectroscopy(
-            laser_frequency_mhz=self.laser_mhz,
-            acquisition_time_seconds=self.acquisition_time_in_seconds_ref
-            )
+            self.ref_baseline = self.histograms.snapshot()
+            self.y_data_ref = np.zeros((len(self.channels), self.bins))
+            self.scheduler.mark_dirty()
+            self.start_source('reference', self.acquisition_time_in_seconds_ref)
             self.stop_button_ref.setEnabled(True)
         elif sender == self.start_button_data:
             self.start_button_data.setEnabled(False)
+            self.export_button.setEnabled(False)
+            self.bins_combobox.setEnabled(False)
             self.acquiring_data = True
-            self.y_data = np.zeros(256)
-            self.api.set_firmware("firmwares\\spectroscopy_40MHz.flim")
-            self.api.acquire_spectroscopy(
-            laser_frequency_mhz=self.laser_mhz,
-            acquisition_time_seconds=self.acquisition_time_in_seconds_data
-            )
+            self.data_baseline = self.batch_baseline = self.histograms.snapshot()
+            self.y_data = np.zeros((len(self.channels), self.bins))
+            self.closed_batches.clear()
+            self.slices.reset()
+            self.window_label.setText('windows: as acquired')
+            self.window_label.adjustSize()
+            self.start_batch_recording()
+            self.scheduler.mark_dirty()
+            self.start_source('data', self.acquisition_time_in_seconds_data)
             self.stop_button_data.setEnabled(True)
 
     
@@ -451,201 +755,384 @@ class MainWindow(QMainWindow):
         sender = self.sender()
         if sender == self.stop_button_ref:
             self.stop_button_ref.setEnabled(False)
+            self.stop_source()
             self.acquiring_ref = False
-            self.api.stop_acquisition()
+            # the new reference replaces the cached one of the current settings
+            self.take_snapshot()
+            self.engine.calibrate(self.y_data_ref)
+            self.store_calibration()
             #self.y_data_ref = np.zeros(256)
             #self.points_received_ref = 0
             self.start_button_ref.setEnabled(True)
+            self.bins_combobox.setEnabled(not self.acquiring_data)
         elif sender == self.stop_button_data:    
             self.stop_button_data.setEnabled(False)
+            self.stop_source()
             self.acquiring_data = False
-            self.api.stop_acquisition()
+            self.slices.flush()
+            # record the batches closed by the last photons and the partial batch left open
+            self.close_pending_batches()
+            snapshot = self.histograms.snapshot()
+            if snapshot.totals['data'].sum() > self.batch_baseline.totals['data'].sum():
+                last_macro_time = (self.batcher or self.acquisition).last_macro_time
+                self.save_and_reset_data(snapshot, last_macro_time)
+            self.stop_batch_recording()
             #self.y_data = np.zeros(256)
-            self.points_received = 0
             self.start_button_data.setEnabled(True) 
-        
-        
-    def receive_point(self, channel, time_bin, micro_time, monotonic_counter, macro_time):
+            self.export_button.setEnabled(True)
+            self.bins_combobox.setEnabled(not self.acquiring_ref)
+        
+        
+    # photons of the acquisition go to the `kind` histogram, from this process or the acquisition process
+    def start_source(self, kind, acquisition_time_seconds):
+        if self.acquisition is not None:
+            self.acquisition.start(kind, self.firmware, self.laser_mhz, acquisition_time_seconds,
+                                   self.recording(kind))
+            return
+        self.ingestor.reset()
+        self.batcher.reset()
+        self.start_recording(kind)
+        self.api.set_firmware(self.firmware)
+        self.api.acquire_spectroscopy(
+        laser_frequency_mhz=self.laser_mhz,
+        acquisition_time_seconds=acquisition_time_seconds
+        )
+        
+    # returns once the last photons are in the histograms
+    def stop_source(self):
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            return
+        self.api.stop_acquisition()
+        self.ingestor.flush()
+        self.stop_recording()
+        
+    # path and metadata of the raw event file of an acquisition, None when recording is off
+    def recording(self, kind):
+        if not self.record_checkbox.isChecked():
+            return None
+        return (f'{kind}_events_{time.strftime("%Y%m%d-%H%M%S")}.bin',
+                dict(laser_mhz=self.laser_mhz, firmware=self.firmware, bin_offset=self.bin_offset, bins=self.bins,
+                     kind=kind, channels=list(self.channels)))
+        
+    def start_recording(self, kind):
+        recording = self.recording(kind)
+        if recording is not None:
+            path, metadata = recording
+            self.recorder = EventRecorder(path, **metadata)
+        
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+        
+    def start_batch_recording(self):
+        self.stop_batch_recording()
+        self.batch_start_ns = 0.0
+        self.batch_recorder = BatchRecorder(f'data_batches_{time.strftime("%Y%m%d-%H%M%S")}.bin',
+                                            laser_mhz=self.laser_mhz, firmware=self.firmware,
+                                            bin_offset=self.bin_offset, bins=self.bins,
+                                            channels=self.channels, metrics=self.metrics,
+                                            harmonic=self.harmonic_value)
+        
+    def stop_batch_recording(self):
+        recorder, self.batch_recorder = self.batch_recorder, None
+        if recorder is not None:
+            recorder.close()
+        
+    def receive_chunk(self, counts, chunk):
+        # counts is the (channels, bins) bincount of a whole chunk of photons, already shifted by the bin offset
+        recorder = self.recorder
+        if recorder is not None and (self.acquiring_ref or self.acquiring_data):
+            recorder.append(chunk)
         if self.acquiring_ref:
-            self.mutex.lock()
-            self.y_data_ref[(time_bin+90)%256] += 1
-            self.points_received_ref += 1            
-            self.mutex.unlock()
+            self.histograms.add('reference', counts)
         elif self.acquiring_data:
-            self.mutex.lock()
-            self.y_data[(time_bin+90)%256] += 1
-            self.y_data_upd[(time_bin+90)%256] += 1
-            self.points_received += 1
-            self.mutex.unlock()   
+            # the snapshot taken at every batch boundary is queued for the GUI to record
+            self.batcher.fold(chunk, counts, self.ingestor.histogram, lambda part: self.histograms.add('data', part),
+                              lambda end: self.closed_batches.append((self.histograms.snapshot(), end)),
+                              self.slices.add, self.slices.base_ns)
             
             #self.x_data_list.append(self.x_data)
             #self.y_data_list.append(self.y_data)    
             
     def frequency_meter(self):
-        self.api.set_consumer_handler(self.receive_measure)
         self.measure_label.setText('Waiting for measure...')
         self.measure_label.adjustSize()
         self.sync_laser_in.setEnabled(False)     
+        self.measured_frequencies.clear()
+        self.measuring_frequency = True
+        if self.acquisition is not None:
+            self.acquisition.measure_frequency("firmwares\\frequency_meter.flim")
+            self.update()
+            return
+        self.api.set_consumer_handler(self.measured_frequencies.append)
         self.api.set_firmware("firmwares\\frequency_meter.flim")
         self.api.acquire_measure_frequency()
         self.update()        
         
+    def poll_frequency(self):
+        # the measure is shown once, from the GUI thread; values the API sends before it is stopped are dropped
+        if not self.measured_frequencies:
+            return
+        frequency = self.measured_frequencies.pop()
+        self.measured_frequencies.clear()
+        if self.measuring_frequency:
+            self.measuring_frequency = False
+            self.receive_measure(frequency)
+        
     def receive_measure(self, frequency):
         self.measure_label.setText('Measurement: ' + str(frequency) + ' MHz')
         self.measure_label.adjustSize()
         self.sync_laser_in.setEnabled(True)
-        self.api.stop_acquisition()
-        self.api.set_consumer_handler(self.receive_point)
+        # the acquisition process stops the measure on its own
+        if self.acquisition is None:
+            self.api.stop_acquisition()
+            self.api.set_consumer_handler(self.ingestor.push)
         self.update()    
     
                
 
+    def take_snapshot(self):
+        # one atomic read of the published histograms, the acquisition thread is never blocked
+        snapshot = self.histograms.snapshot()
+        if self.ref_baseline is not None:
+            self.y_data_ref = snapshot.histograms['reference'] - self.ref_baseline.histograms['reference']
+            self.points_received_ref = int((snapshot.totals['reference'] - self.ref_baseline.totals['reference']).sum())
+        if self.data_baseline is not None:
+            self.y_data = snapshot.histograms['data'] - self.data_baseline.histograms['data']
+            self.y_data_upd = snapshot.histograms['data'] - self.batch_baseline.histograms['data']
+            self.points_received = int((snapshot.totals['data'] - self.data_baseline.totals['data']).sum())
+        return snapshot
+        
+    def data_phasor_sums(self, snapshot):
+        # running sums of the batch and global histograms of every channel, (2, channels, 2H),
+        # read in O(1) from the store
+        if self.data_baseline is None:
+            return self.engine.phasor_sums(np.stack((self.y_data_upd, self.y_data)))
+        basis = self.engine.basis
+        sums = self.histograms.phasor_sums(snapshot, 'data', basis)
+        total = snapshot.totals['data']
+        sums = np.stack((sums - self.histograms.phasor_sums(self.batch_baseline, 'data', basis),
+                         sums - self.histograms.phasor_sums(self.data_baseline, 'data', basis)))
+        totals = np.array([total - self.batch_baseline.totals['data'], total - self.data_baseline.totals['data']])
+        return sums, totals
+        
+    def poll_frame_sources(self):
+        # runs on every scheduler tick: cheap checks that decide which views need a redraw
+        snapshot = self.histograms.snapshot()
+        if snapshot.sequence != self.last_snapshot.sequence:
+            if (snapshot.totals['reference'] != self.last_snapshot.totals['reference']).any():
+                self.scheduler.mark_dirty('reference', 'phasor')
+            if (snapshot.totals['data'] != self.last_snapshot.totals['data']).any():
+                self.scheduler.mark_dirty('data', 'phasor')
+            self.last_snapshot = snapshot
+        self.close_pending_batches()
+        
+    def photons_per_second(self):
+        return (self.ingestor or self.acquisition).photons_per_second
+        
+    def poll_metrics(self):
+        now = time.perf_counter()
+        if now - self.last_metrics_time < self.metrics_interval:
+            return
+        self.last_metrics_time = now
+        snapshot = self.metrics.snapshot()
+        # a failing write is shown in the panel instead of being reported every second
+        try:
+            self.metrics_writer.write(snapshot)
+            error = ''
+        except OSError as e:
+            error = f'\nmetrics not written: {e}'
+        # the ingestion metrics come from the acquisition process in process mode
+        values = flatten(snapshot)
+        source = 'process_' if self.acquisition is not None else ''
+        def p99_ms(name):
+            return values.get(f'{name}_p99_s', 0.0) * 1000
+        self.metrics_label.setText(
+            f'events/s {values.get(source + "events_per_s", 0):,.0f}   '
+            f'dropped {values.get(source + "events_dropped_total", 0):,.0f}   '
+            f'overflow {values.get(source + "overflow_dropped_total", 0):,.0f}   '
+            f'lost {values.get(source + "lost_events_total", 0):,.0f} '
+            f'({values.get(source + "counter_gaps_total", 0):,.0f} gaps)   '
+            f'decimation 1/{values.get(source + "decimation", 1):.0f}\n'
+            f'p99 (ms): callback {p99_ms(source + "callback"):.3f}  fold {p99_ms(source + "fold"):.2f}  '
+            f'publish {p99_ms(source + "publish"):.3f}  frame {p99_ms("frame"):.1f}  '
+            f'batch {p99_ms("save_batch"):.1f}  export {p99_ms("export"):.0f}\n'
+            f'depths: chunk {values.get(source + "buffer_depth", 0):,.0f}  '
+            f'queue {values.get(source + "queue_depth", 0):.0f}  batches {values["closed_batches"]}  '
+            f'batch file {values["batch_queue"]}  exports {values["export_pending"]}  fits {values["fits_pending"]}' + error)
+        self.metrics_label.adjustSize()
+        
+    def poll_export(self):
+        exporter = self.exporter
+        self.export_progress.setValue(int(exporter.progress * 100))
+        queued = f' ({exporter.pending - 1} queued)' if exporter.pending > 1 else ''
+        self.export_progress.setFormat(f'export: {exporter.status}{queued}')
+        
+    def poll_fits(self):
+        fitter = self.fitter
+        fit = None
+        while fitter.results:
+            record, fits = fitter.results.popleft()
+            for i, fit in enumerate(fits):
+                columns = {'chi2': fit.chi2}
+                for k, (tau, amplitude) in enumerate(zip(fit.taus, fit.amplitudes), 1):
+                    columns[f'tau_{k}'] = tau
+                    columns[f'a_{k}'] = amplitude
+                self.phasor_history.update(record + i, **columns)
+            fit = fits[self.channel_view]
+        if fit is not None:
+            taus = ', '.join(f'{tau:.3f}' for tau in fit.taus)
+            amplitudes = ', '.join(f'{amplitude:.3f}' for amplitude in fit.amplitudes)
+            pending = f' ({fitter.pending} pending)' if fitter.pending else ''
+            self.fit_label.setText(f'lifetime fit: tau (ns) = {taus}, amplitudes = {amplitudes}, '
+                                   f'chi2 = {fit.chi2:.3f}{pending}')
+            self.fit_label.adjustSize()
+        
+    def close_pending_batches(self):
+        while self.closed_batches:
+            with self.metrics.timer('save_batch'):
+                self.save_and_reset_data(*self.closed_batches.popleft())
+        
     def refresh_histogram_ref(self):
-        self.canvas1.ax2.clear()
-        self.canvas1.ax2.plot(self.x_data, self.y_data_ref)
-        #self.chart.axes.set_xlabel('Time (ns)')
-        #self.chart.axes.set_ylabel('Photon counts')
-        self.canvas1.ax2.set_xlim([0, 1000 / self.laser_mhz])
-        self.canvas1.ax2.set_title('TCSPC calibration sample')
-        self.canvas1.ax2.set_xlabel('Time (ns)')
-        self.canvas1.ax2.set_ylabel('Counts')
-        self.canvas1.draw()
+        self.take_snapshot()
+        for line, y in zip(self.lines_ref, self.y_data_ref):
+            self.renderer1.set_line_data(line, self.x_data, y)
+        self.renderer1.autoscale_y(self.canvas1.ax2, self.y_data_ref)
+        self.renderer1.update()
         # format points received with commas
-        self.phase_label_ref.setText(f'Total photons: {self.points_received_ref:,}')
-        self.s_reference = (self.sine_reference*self.y_data_ref).sum()/self.y_data_ref.sum() 
-        self.g_reference = (self.cosine_reference*self.y_data_ref).sum()/self.y_data_ref.sum() 
-        
-        self.phi_reference = math.atan2(self.s_reference,self.g_reference)
-        self.m_reference = np.sqrt(self.g_reference**2+self.s_reference**2)
-        self.phi_instr = self.phi_reference - self.phi
-        self.m_instr = self.m_reference/self.m 
-        self.tau_ref_modulus_label_ref.setText('IRF modulus =' +str(np.round(self.m_instr,4)))
-        self.tau_ref_phase_label_ref.setText('IRF phase =' +str(np.round(self.phi_instr,4)))
+        self.phase_label_ref.setText(f'Total photons: {self.points_received_ref:,} ({self.photons_per_second():,.0f} photons/s)')
+        # every channel is calibrated on its own reference histogram
+        self.engine.calibrate(self.y_data_ref)
+        c = self.channel_view
+        self.tau_ref_modulus_label_ref.setText('IRF modulus =' +str(np.round(self.engine.m_instr[c],4)))
+        self.tau_ref_phase_label_ref.setText('IRF phase =' +str(np.round(self.engine.phi_instr[c],4)))
         self.phase_label_ref.adjustSize()
         
     def refresh_histogram(self):
-        self.canvas2.ax1.clear()
-        self.canvas2.ax1.plot(self.x_data, self.y_data)
-        #self.chart.axes.set_xlabel('Time (ns)')
-        #self.chart.axes.set_ylabel('Photon counts')
-        self.canvas2.ax1.set_xlim([0, 1000 / self.laser_mhz])
-        self.canvas2.ax1.set_title('Global decay histogram')
-        self.canvas2.ax1.set_xlabel('Time (ns)')
-        self.canvas2.ax1.set_ylabel('Counts')
-        self.canvas2.draw_idle()
+        self.take_snapshot()
+        for line, y in zip(self.lines_data, self.y_data):
+            self.renderer2.set_line_data(line, self.x_data, y)
+        self.renderer2.autoscale_y(self.canvas2.ax1, self.y_data)
+        self.renderer2.update()
         # format points received with commas
-        self.phase_label.setText(f'Total photons: {self.points_received:,}')
+        self.phase_label.setText(f'Total photons: {self.points_received:,} ({self.photons_per_second():,.0f} photons/s)')
         self.phase_label.adjustSize() 
+        self.frame_label.setText('frame time (ms): ' + '   '.join(
+            f'canvas{n + 1} p50 {r.frame_time_ms(50):.1f} p99 {r.frame_time_ms(99):.1f}'
+            for n, r in enumerate((self.renderer1, self.renderer2, self.renderer3))))
+        self.frame_label.adjustSize()
         
      
     def update_canvas2(self):
-        self.mutex.lock()
-        self.canvas2.ax2.clear()
-        self.canvas2.ax2.plot(self.x_data, self.y_data_upd)
-        self.canvas2.ax2.set_xlim([0, 1000 / self.laser_mhz])
-        self.canvas2.ax2.set_title(f'{self.refresh_time_seconds} seconds TCSPC data sample')
-        self.canvas2.ax2.set_xlabel('Time (ns)')
-        self.canvas2.ax2.set_ylabel('Counts')
-        self.canvas2.draw_idle()
-        
-        if self.acquiring_data:
-           QTimer.singleShot(self.refresh_time_seconds * 1000, self.save_and_reset_data)
+        snapshot = self.take_snapshot()
+        for line, y in zip(self.lines_data_upd, self.y_data_upd):
+            self.renderer2.set_line_data(line, self.x_data, y)
+        self.renderer2.autoscale_y(self.canvas2.ax2, self.y_data_upd)
+        self.renderer2.update()
            
-        S = np.sum(self.y_data_upd * self.sine_reference) / np.sum(self.y_data_upd)
-        G = np.sum(self.y_data_upd * self.cosine_reference) / np.sum(self.y_data_upd)
-        m_data = np.sqrt(G**2+S**2) 
-        phi_data = np.arctan2(S,G) 
-         
-        m_fluo = m_data/self.m_instr  
-        phi_fluo = phi_data - self.phi_instr
-        g_data_referenced = m_fluo*np.cos(phi_fluo) 
-        s_data_referenced = m_fluo*np.sin(phi_fluo)  
-        
-        if self.acquiring_data:
-           self.g_data_excel_list.append(g_data_referenced)
-           self.s_data_excel_list.append(s_data_referenced)
-           self.m_fluo_list.append(m_fluo)
-           self.phi_fluo_list.append(phi_fluo)
-              
-        #print(len(self.g_data_excel_list)) 
-        #print(len(self.s_data_excel_list))     
-        #print(len(self.m_fluo_list)) 
-        #print(len(self.m_fluo_list))         
-        
-        S_1 = np.sum(self.y_data * self.sine_reference) / np.sum(self.y_data)
-        G_1 = np.sum(self.y_data * self.cosine_reference) / np.sum(self.y_data)
-        m_data_1 = np.sqrt(G_1**2 + S_1**2) 
-        phi_data_1 = np.arctan2(S_1,G_1) 
-         
-        m_fluo_1 = m_data_1 / self.m_instr  
-        phi_fluo_1 = phi_data_1 - self.phi_instr
-        g_data_referenced_1 = m_fluo_1 * np.cos(phi_fluo_1) 
-        s_data_referenced_1 = m_fluo_1 * np.sin(phi_fluo_1) 
+        # global histogram, all channels and harmonics, through the engine in a single vectorized
+        # call; the batch phasors are recorded when the batch closes in save_and_reset_data
+        result = self.engine.compute_harmonics_from_sums(*self.data_phasor_sums(snapshot))
+        h = self.harmonic_value - 1
+        c = self.channel_view
+        g_data_referenced_1 = result.g[1, c, h]
+        s_data_referenced_1 = result.s[1, c, h]
+        tau_p, tau_m = result.tau_phase[1, c, h], result.tau_modulation[1, c, h]
+        self.harmonics_label.setText('   '.join(f'H{n + 1}: g = {g:.3f}, s = {s:.3f}'
+                                                for n, (g, s) in enumerate(zip(result.g[1, c], result.s[1, c]))))
+        self.harmonics_label.adjustSize()
+        
         self.g_label.setText('g =' +str(np.round(g_data_referenced_1,3)))
         self.s_label.setText('s =' +str(np.round(s_data_referenced_1,3)))
         self.g_label.adjustSize()
         self.s_label.adjustSize()
         
         
-        phi_fluo_avg = np.arctan2(s_data_referenced_1, g_data_referenced_1)
-        m_fluo_avg = np.sqrt(g_data_referenced_1**2 + s_data_referenced_1**2)
-
-        tau_p = self.k*math.tan(phi_fluo_avg)
-        
-        par = (1/m_fluo_avg**2)
-        tau_m = self.k*np.sqrt(par-1)
-        
         self.tau_life_phase_label.setText('tau_phase =' + str(np.round(tau_p*1e9,3)))
         self.tau_life_mod_label.setText('tau_modulation =' + str(np.round(tau_m*1e9,3)))
         
-        if self.acquiring_data:
-           self.g_data_referenced_list.append(g_data_referenced)
-           self.s_data_referenced_list.append(s_data_referenced)
-        
-        # Update the phasor plot di sinistra (un solo punto)
-        self.canvas3.ax1.clear()
-        self.canvas3.ax1.set_xlim([-0.005,1.2])
-        self.canvas3.ax1.set_ylim([0, 0.6])
-        self.canvas3.ax1.plot(g_data_referenced_1, s_data_referenced_1, 'bo')  #non mi mostrava il plot perchè a denominatore G e S hanno 0  non avendo ancora acquisito i dati e avendoli inizializzati a zero
-        #self.canvas3.ax1.set_xlim([0, 1])
-        self.canvas3.ax1.set_title('Global phasor plot')
-        self.canvas3.ax1.set_xlabel('g')
-        self.canvas3.ax1.set_ylabel('s')
-        self.canvas3.ax1.contour(self.X_2,self.Y_2,self.F_2,[0],colors='b',linewidths=3)
-        # Update the phasor plot di destra
-        
-        self.canvas3.ax2.clear()
-        self.canvas3.ax2.set_xlim([-0.005, 1.2])
-        self.canvas3.ax2.set_ylim([0, 0.6])
-        self.canvas3.ax2.plot(self.g_data_referenced_list, self.s_data_referenced_list, 'bo')
-        self.canvas3.ax2.set_title(f'{self.refresh_time_seconds} seconds Refreshed phasor plot')
-        self.canvas3.ax2.set_xlabel('g')
-        self.canvas3.ax2.set_ylabel('s')
-        self.canvas3.ax2.contour(self.X, self.Y, self.F, [0], colors='b', linewidths=3)
-        
-        
-       
-        self.canvas3.draw()
-        
-        
-        self.mutex.unlock()
+        # Update the phasor plot di sinistra (un punto per canale)
+        for point, g, s in zip(self.global_points, result.g[1, :, h], result.s[1, :, h]):
+            point.set_data([g], [s])
+        # Update the phasor plot di destra (density map of all the batches)
+        image = self.phasor_density.image()
+        self.density_image.set_data(image)
+        self.density_image.set_clim(0, max(np.log1p(self.phasor_density.counts.max()), 1))
+        self.renderer3.update()
 
         
     
-    def save_and_reset_data(self):
-        filename = f'data_batch_{self.batch_counter}.txt'
-        np.savetxt(filename, np.vstack((self.x_data, self.y_data_upd)).T)
+    def save_and_reset_data(self, snapshot, end_ns):
+        # snapshot: histograms at the macro time boundary end_ns that closes the batch
+        self.y_data_upd = snapshot.histograms['data'] - self.batch_baseline.histograms['data']
+        # phasor of the batch that is closing
+        result = self.engine.compute_harmonics_from_sums(*self.data_phasor_sums(snapshot))
+        h = self.harmonic_value - 1
+        g_data_referenced, s_data_referenced = result.g[0, :, h], result.s[0, :, h]
+        m_fluo, phi_fluo = result.m[0, :, h], result.phi[0, :, h]
+        photons = self.y_data_upd.sum(axis=-1)
+        record = len(self.phasor_history)
+        for i, channel in enumerate(self.channels):
+            self.phasor_history.append(channel=channel, start_ns=self.batch_start_ns, end_ns=end_ns,
+                                       photons=photons[i], g=g_data_referenced[i], s=s_data_referenced[i],
+                                       m=m_fluo[i], phi=phi_fluo[i])
+            self.phasor_densities[i].add(g_data_referenced[i], s_data_referenced[i])
+        # the records of the batch, one per channel, get their fit when the pool is done with it;
+        # the calibration reference is the IRF of the fit
+        if self.fit_checkbox.isChecked():
+            self.fitter.submit(record, self.y_data_upd, self.y_data_ref, self.laser_period_in_nanoseconds,
+                               self.tau_phase_reference)
+        
+        # queued for the background writer of the batch file, data_batch_N.txt files are
+        # produced on demand with batch_store.py --text
+        if self.batch_recorder is not None:
+            self.batch_recorder.append(self.batch_start_ns, end_ns, self.y_data_upd, g_data_referenced,
+                                       s_data_referenced, m_fluo, phi_fluo)
+        self.batch_start_ns = end_ns
         self.batch_counter += 1
+        # the next batch starts from this snapshot, the photons of the store are left untouched
+        self.batch_baseline = snapshot
         self.y_data_upd = np.zeros_like(self.y_data_upd)  #qui è la chiave del problema   
-        self.canvas2.ax2.clear()
-        self.canvas2.ax2.plot(self.x_data, self.y_data_upd)
-        self.canvas2.ax2.set_title('TCSPC')
-        self.canvas2.ax2.set_xlabel('Time (ns)')
-        self.canvas2.ax2.set_ylabel('Counts')
-        self.canvas2.draw_idle()
-        #QTimer.singleShot(self.refresh_time_seconds * 1000, self.update_canvas2) #prova a moltiplicare refreshed_time per 1000
-        
-    def save_to_excel(self):
+        self.scheduler.mark_dirty('phasor')
+        
+    # batch phasors of the last data acquisition recomputed from its slices for the current window
+    # length and step: the phasor history, the density plots, the fits and the export follow them
+    def rewindow(self):
+        start = time.perf_counter()
+        starts, ends, sums, totals = self.slices.window_sums(self.engine.basis, self.refresh_time_seconds,
+                                                             self.window_step_seconds)
+        result = self.engine.compute_harmonics_from_sums(sums, totals)
+        h = self.harmonic_value - 1
+        channels = len(self.channels)
+        columns = self.phasor_history.columns
+        self.phasor_history.close()
+        self.phasor_history = PhasorHistory(columns, window=self.phasor_window)
+        self.phasor_history.extend(channel=np.tile(self.channels, len(starts)), start_ns=np.repeat(starts, channels),
+                                   end_ns=np.repeat(ends, channels), photons=totals.ravel(),
+                                   g=result.g[..., h].ravel(), s=result.s[..., h].ravel(),
+                                   m=result.m[..., h].ravel(), phi=result.phi[..., h].ravel())
+        for i, density in enumerate(self.phasor_densities):
+            density.reset()
+            density.add(result.g[:, i, h], result.s[:, i, h])
+        # fits of the old batches are dropped, the new windows are fitted if fitting is on
+        self.fitter.discard()
+        if self.fit_checkbox.isChecked():
+            histograms = self.slices.window_histograms(self.refresh_time_seconds, self.window_step_seconds)
+            for k, histogram in enumerate(histograms):
+                self.fitter.submit(k * channels, histogram, self.y_data_ref, self.laser_period_in_nanoseconds,
+                                   self.tau_phase_reference)
+        step = f', step {self.window_step_seconds:g} s' if self.window_step_seconds else ''
+        # a window longer than the acquisition is cut to the acquisition
+        if len(starts) == 1 and ends[0] - starts[0] < self.refresh_time_seconds * 1e9 * (1 - 1e-9):
+            step += f', acquisition of {ends[0] / 1e9:g} s only'
+        self.window_label.setText(f'windows: {len(starts)} of {self.refresh_time_seconds:g} s{step} '
+                                  f'({(time.perf_counter() - start) * 1000:.1f} ms)')
+        self.window_label.adjustSize()
+        self.scheduler.mark_dirty('phasor')
+        
+    def save_phasors(self):
         #for _ in range(len(self.x_data_list) - len(self.g_data_excel_list)):
            
          #   self.g_data_excel_list.append(0)
@@ -655,11 +1142,17 @@ class MainWindow(QMainWindow):
         data = {
             #'time bin': self.x_data_list,
             #'photon count': self.y_data_list,
-            'g_data': self.g_data_excel_list,
-            's_data': self.s_data_excel_list,
-            'm_fluo': self.m_fluo_list,
-            'phi_fluo': self.phi_fluo_list
+            'g_data': self.phasor_history.column('g'),
+            's_data': self.phasor_history.column('s'),
+            'm_fluo': self.phasor_history.column('m'),
+            'phi_fluo': self.phasor_history.column('phi')
         }
+        # one row per batch and channel
+        if len(self.channels) > 1:
+            data = {'channel': self.phasor_history.column('channel'), **data}
+        # fit columns once batches were fitted
+        if np.isfinite(self.phasor_history.column('chi2')).any():
+            data.update({name: self.phasor_history.column(name) for name in self.fit_columns})
         
         #data_1 = {
         
@@ -667,9 +1160,8 @@ class MainWindow(QMainWindow):
           #  'photon count': self.y_data_list
         #}
 
-        df = pd.DataFrame(data)
-        #df_1 = pd.DataFrame(data_1)
-        df.to_excel('phasors_data.xlsx', index=False)    
+        # phasors_data.csv / .parquet / .xlsx, written by the exporter thread
+        self.exporter.save_columns('phasors_data', data, self.export_format)
         #df_1.to_excel('TCSPC_data.xlsx', index=False)
         
     
@@ -682,7 +1174,24 @@ class MainWindow(QMainWindow):
         
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description='Phasor analysis GUI')
+    parser.add_argument('--simulate', action='store_true', help='photons from the simulated source')
+    parser.add_argument('--process', action='store_true', help='acquisition and accumulation in a separate process')
+    parser.add_argument('--prometheus', action='store_true', help='metrics written to metrics.prom')
+    parser.add_argument('--bins', type=int, default=256, choices=(256, 1024, 4096), help='time bins per laser period')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1],
+                        help='acquired channels, each with its own histograms and phasors')
+    overflow = parser.add_mutually_exclusive_group()
+    overflow.add_argument('--drop', action='store_true', help='drop new photons when folding falls behind')
+    overflow.add_argument('--decimate', action='store_true', help='decimate new photons when folding falls behind')
+    parser.add_argument('--counter-is-index', action='store_true',
+                        help='monotonic_counter numbers the events: count the lost ones from its gaps')
+    # the arguments argparse does not know are left to Qt
+    args, qt_args = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(simulate=args.simulate, process=args.process, bins=args.bins, channels=args.channels,
+                        metrics_format='prometheus' if args.prometheus else 'jsonl',
+                        overflow='drop' if args.drop else 'decimate' if args.decimate else 'block',
+                        counter_is_index=args.counter_is_index)
     window.show()
     sys.exit(app.exec_())
\ No newline at end of file
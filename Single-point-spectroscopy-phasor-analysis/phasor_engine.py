@@ -0,0 +1,156 @@
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+
+# calibrated phasor coordinates, modulus, phase and single-exponential lifetimes (seconds)
+PhasorResult = namedtuple('PhasorResult', ['g', 's', 'm', 'phi', 'tau_phase', 'tau_modulation'])
+
+
+# (2 * harmonics, bins) table: rows 0..H-1 are the cosines, rows H..2H-1 the sines of
+# harmonics 1..H. Memoized and read-only, so engines and histogram stores with the
+# same settings share one table and a setting that does not change it keeps its identity.
+@lru_cache(maxsize=32)
+def basis_table(laser_mhz, bins, harmonics):
+    laser_period_in_nanoseconds = 1000 / laser_mhz
+    x_data = np.linspace(0, laser_period_in_nanoseconds, bins)
+    n = np.arange(1, harmonics + 1)
+    omega_t = 2 * np.pi * n[:, None] * x_data / laser_period_in_nanoseconds
+    basis = np.vstack((np.cos(omega_t), np.sin(omega_t)))
+    basis.flags.writeable = False
+    return basis
+
+
+class PhasorEngine:
+    """Qt-free phasor computation: calibration on a reference fluorophore and
+    calibrated g, s, m, phi and lifetimes for one or many TCSPC histograms.
+    A (channels, bins) reference calibrates every channel separately; the
+    histograms to compute then broadcast against it, e.g. (N, channels, bins).
+
+    Harmonics 1..harmonics are always evaluated together with a single
+    product against a precomputed (2 * harmonics, bins) cos/sin basis, each
+    with its own calibration. `harmonic` selects the one returned by compute.
+    """
+
+    def __init__(self, laser_mhz=40, bins=256, harmonic=1, tau_phase_reference=4, tau_modulation_reference=4,
+                 harmonics=2):
+        self.laser_mhz = laser_mhz
+        self.bins = bins
+        self.harmonic = harmonic
+        self.harmonics = harmonics
+        self.tau_phase_reference = tau_phase_reference
+        self.tau_modulation_reference = tau_modulation_reference
+        self.reference_histogram = None
+        self._update()
+
+    def set_laser_frequency(self, laser_mhz):
+        self.laser_mhz = laser_mhz
+        self._update()
+
+    def set_bins(self, bins):
+        self.bins = bins
+        if self.reference_histogram is not None and self.reference_histogram.shape[-1] != bins:
+            self.reference_histogram = None
+        self._update()
+
+    def set_harmonic(self, harmonic):
+        self.harmonic = harmonic
+        self._update()
+
+    def set_harmonics(self, harmonics):
+        self.harmonics = harmonics
+        self._update()
+
+    def set_tau_phase_reference(self, tau_phase_reference):
+        self.tau_phase_reference = tau_phase_reference
+        self._update()
+
+    def set_tau_modulation_reference(self, tau_modulation_reference):
+        self.tau_modulation_reference = tau_modulation_reference
+        self._update()
+
+    def _update(self):
+        self.harmonics = max(self.harmonics, self.harmonic)
+        self.laser_period_in_nanoseconds = 1000 / self.laser_mhz
+        self.x_data = np.linspace(0, self.laser_period_in_nanoseconds, self.bins)
+        n = np.arange(1, self.harmonics + 1)
+        self.basis = basis_table(self.laser_mhz, self.bins, self.harmonics)
+        self.cosine_reference = self.basis[self.harmonic - 1]
+        self.sine_reference = self.basis[self.harmonics + self.harmonic - 1]
+
+        # expected phase and modulus of the reference fluorophore, per harmonic
+        self.k_harmonics = 1 / (2 * np.pi * n * self.laser_mhz * 1e6)
+        self.phi_harmonics = np.arctan2(self.tau_phase_reference * 1e-9, self.k_harmonics)
+        self.m_harmonics = np.sqrt(1 / (1 + ((self.tau_modulation_reference * 1e-9 / self.k_harmonics) ** 2)))
+        self.k = self.k_harmonics[self.harmonic - 1]
+        self.phi = self.phi_harmonics[self.harmonic - 1]
+        self.m = self.m_harmonics[self.harmonic - 1]
+
+        if self.reference_histogram is None:
+            self.phi_instr_harmonics = np.zeros(self.harmonics)
+            self.m_instr_harmonics = np.ones(self.harmonics)
+            self._select_calibration()
+        else:
+            self.calibrate(self.reference_histogram)
+
+    def _select_calibration(self):
+        self.phi_instr = self.phi_instr_harmonics[..., self.harmonic - 1]
+        self.m_instr = self.m_instr_harmonics[..., self.harmonic - 1]
+
+    # sums of cos and sin of every harmonic (trailing axis of length 2 * harmonics)
+    # and photon totals of a (bins,) histogram or a (N, bins) stack of histograms
+    def phasor_sums(self, histograms):
+        histograms = np.asarray(histograms, dtype=np.float64)
+        return histograms @ self.basis.T, histograms.sum(axis=-1)
+
+    # uncalibrated G and S for all harmonics at once: the results have a trailing
+    # axis of length `harmonics`
+    def raw_phasor_harmonics(self, histograms):
+        return self.raw_phasor_from_sums(*self.phasor_sums(histograms))
+
+    def raw_phasor_from_sums(self, sums, totals):
+        sums = np.asarray(sums, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            projections = sums / np.asarray(totals, dtype=np.float64)[..., None]
+        return projections[..., :self.harmonics], projections[..., self.harmonics:]
+
+    def raw_phasor(self, histograms):
+        G, S = self.raw_phasor_harmonics(histograms)
+        return G[..., self.harmonic - 1], S[..., self.harmonic - 1]
+
+    def calibrate(self, reference_histogram):
+        self.reference_histogram = np.array(reference_histogram, dtype=np.float64)
+        g, s = self.raw_phasor_harmonics(self.reference_histogram)
+        phi_reference = np.arctan2(s, g)
+        m_reference = np.sqrt(g ** 2 + s ** 2)
+        self.phi_instr_harmonics = phi_reference - self.phi_harmonics
+        self.m_instr_harmonics = m_reference / self.m_harmonics
+        self.g_reference, self.s_reference = g[..., self.harmonic - 1], s[..., self.harmonic - 1]
+        self.phi_reference = phi_reference[..., self.harmonic - 1]
+        self.m_reference = m_reference[..., self.harmonic - 1]
+        self._select_calibration()
+
+    def compute_harmonics(self, histograms):
+        return self.compute_harmonics_from_sums(*self.phasor_sums(histograms))
+
+    # same as compute_harmonics, from running sums instead of full histograms
+    def compute_harmonics_from_sums(self, sums, totals):
+        G, S = self.raw_phasor_from_sums(sums, totals)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m_data = np.sqrt(G ** 2 + S ** 2)
+            phi_data = np.arctan2(S, G)
+
+            m_fluo = m_data / self.m_instr_harmonics
+            phi_fluo = phi_data - self.phi_instr_harmonics
+            g = m_fluo * np.cos(phi_fluo)
+            s = m_fluo * np.sin(phi_fluo)
+
+            tau_phase = self.k_harmonics * np.tan(phi_fluo)
+            tau_modulation = self.k_harmonics * np.sqrt(1 / m_fluo ** 2 - 1)
+        return PhasorResult(g, s, m_fluo, phi_fluo, tau_phase, tau_modulation)
+
+    # results of the selected harmonic only
+    def compute(self, histograms):
+        result = self.compute_harmonics(histograms)
+        return PhasorResult(*(value[..., self.harmonic - 1] for value in result))
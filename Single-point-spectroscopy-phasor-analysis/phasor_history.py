@@ -0,0 +1,93 @@
+import tempfile
+
+import numpy as np
+
+
+class PhasorHistory:
+    """Columnar store of the per-batch phasor results.
+
+    Every column is a preallocated array and a batch appends one value per
+    column. At most window records are kept in memory: when the columns are
+    full, their oldest half is spilled to a file (a temporary one unless
+    spill_path is given) and the rest is moved to the front. Memory stays flat
+    on long acquisitions and recent() never returns more than window records;
+    column() reads back the whole history, spilled records included.
+    Columns missing from an append are NaN until update() fills them, e.g.
+    with results that arrive after the batch was recorded.
+    """
+
+    def __init__(self, columns=('start_ns', 'end_ns', 'photons', 'g', 's', 'm', 'phi'), window=10000,
+                 spill_path=None, dtype=np.float64):
+        self.columns = tuple(columns)
+        self.dtype = np.dtype([(name, dtype) for name in self.columns])
+        self.window = max(window, 2)
+        self.spill_path = spill_path
+        self._data = {name: np.empty(self.window, dtype=dtype) for name in self.columns}
+        self._n = 0
+        self.spilled = 0
+        self._spill = None
+
+    def __len__(self):
+        return self.spilled + self._n
+
+    def append(self, **values):
+        if self._n == self.window:
+            self._spill_oldest()
+        for name in self.columns:
+            self._data[name][self._n] = values.get(name, np.nan)
+        self._n += 1
+
+    # appends len(values) records at once, e.g. the windows of a SliceHistory
+    def extend(self, **columns):
+        n = len(next(iter(columns.values())))
+        done = 0
+        while done < n:
+            if self._n == self.window:
+                self._spill_oldest()
+            take = min(n - done, self.window - self._n)
+            for name in self.columns:
+                values = columns.get(name)
+                self._data[name][self._n:self._n + take] = np.nan if values is None else values[done:done + take]
+            self._n += take
+            done += take
+
+    def _spill_oldest(self):
+        n = self.window // 2
+        if self._spill is None:
+            self._spill = open(self.spill_path, 'w+b') if self.spill_path else tempfile.TemporaryFile()
+        records = np.empty(n, dtype=self.dtype)
+        for name, column in self._data.items():
+            records[name] = column[:n]
+            column[:self._n - n] = column[n:self._n]
+        self._spill.write(records.tobytes())
+        self._n -= n
+        self.spilled += n
+
+    # record index is the position in the whole history, as counted by len()
+    def update(self, index, **values):
+        if index >= self.spilled:
+            for name, value in values.items():
+                self._data[name][index - self.spilled] = value
+            return
+        # spilled record: overwrite its fields in the file, appends go on at its end
+        for name, value in values.items():
+            field, offset = self.dtype.fields[name]
+            self._spill.seek(index * self.dtype.itemsize + offset)
+            self._spill.write(np.array(value, dtype=field).tobytes())
+        self._spill.seek(0, 2)
+        
+    # last records kept in memory; a view that is only valid until the next append
+    def recent(self, name):
+        return self._data[name][:self._n]
+
+    def column(self, name):
+        if self.spilled == 0:
+            return self.recent(name).copy()
+        self._spill.flush()
+        spilled = np.memmap(self._spill, dtype=self.dtype, mode='r', shape=(self.spilled,))
+        return np.concatenate((spilled[name], self.recent(name)))
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
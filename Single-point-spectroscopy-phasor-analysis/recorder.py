@@ -0,0 +1,115 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+
+# one fixed-size record per photon, as delivered to the FlimLabsApi consumer handler
+EVENT_DTYPE = np.dtype([
+    ('channel', '<u1'),
+    ('time_bin', '<u2'),
+    ('micro_time', '<f4'),
+    ('monotonic_counter', '<u8'),
+    ('macro_time', '<f8'),
+])
+
+MAGIC = b'FLIMPHOT'
+HEADER_SIZE = 4096
+# magic, record count, length of the JSON metadata that follows
+_HEADER_STRUCT = struct.Struct('<8sQI')
+
+
+class EventRecorder:
+    """Appends raw photon events to a binary file of EVENT_DTYPE records.
+
+    The file starts with a HEADER_SIZE bytes header (magic, record count and
+    JSON metadata such as laser MHz, firmware and bin offset) followed by the
+    records. The record area grows in preallocated memory-mapped segments, and
+    every chunk is copied in with vectorized assignments, so recording costs no
+    Python object per photon.
+    """
+
+    # record layout and file magic, overridden by other record files in the same container
+    dtype = EVENT_DTYPE
+    magic = MAGIC
+
+    def __init__(self, path, laser_mhz, firmware, bin_offset, bins=256, segment_events=1 << 22, **metadata):
+        self.path = path
+        self.segment_events = segment_events
+        self.metadata = dict(metadata, laser_mhz=laser_mhz, firmware=firmware, bin_offset=bin_offset,
+                             bins=bins, dtype=self.dtype.descr)
+        self.count = 0
+        self._segment = None
+        self._segment_start = 0
+        self._file = open(path, 'w+b')
+        self._write_header()
+        self._grow()
+
+    def _write_header(self):
+        metadata = json.dumps(self.metadata).encode()
+        header = _HEADER_STRUCT.pack(self.magic, self.count, len(metadata)) + metadata
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Event file metadata does not fit in the header')
+        self._file.seek(0)
+        self._file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self._file.flush()
+
+    # maps a new segment right after the events written so far
+    def _grow(self):
+        if self._segment is not None:
+            self._segment.flush()
+        self._segment_start = self.count
+        self._file.truncate(HEADER_SIZE + (self.count + self.segment_events) * self.dtype.itemsize)
+        self._segment = np.memmap(self._file, dtype=self.dtype, mode='r+',
+                                  offset=HEADER_SIZE + self.count * self.dtype.itemsize,
+                                  shape=(self.segment_events,))
+        self._write_header()
+
+    # chunk: dict of equally long arrays, as passed by PhotonIngestor to its sink
+    def append(self, chunk):
+        n = len(chunk[self.dtype.names[0]])
+        done = 0
+        while done < n:
+            position = self.count - self._segment_start
+            if position == self.segment_events:
+                self._grow()
+                position = 0
+            take = min(n - done, self.segment_events - position)
+            records = self._segment[position:position + take]
+            for name in self.dtype.names:
+                records[name] = chunk[name][done:done + take]
+            self.count += take
+            done += take
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._segment.flush()
+        self._segment = None
+        self._file.truncate(HEADER_SIZE + self.count * self.dtype.itemsize)
+        self._write_header()
+        self._file.close()
+
+
+# header metadata and a read-only memory map of the records of a file written
+# by EventRecorder or one of its subclasses; the record dtype is read from the header
+def read_records(path, magic=MAGIC):
+    with open(path, 'rb') as f:
+        file_magic, count, length = _HEADER_STRUCT.unpack(f.read(_HEADER_STRUCT.size))
+        if file_magic != magic:
+            raise ValueError(f'{path} is not a {magic.decode()} file')
+        metadata = json.loads(f.read(length))
+    # JSON turned the descr tuples, and the shape of subarray fields, into lists
+    dtype = np.dtype([tuple(tuple(item) if isinstance(item, list) else item for item in field)
+                      for field in metadata['dtype']])
+    # the count of a recording that was not closed only covers the segments before the last one
+    count = min(count, (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize)
+    if count == 0:
+        return metadata, np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+    return metadata, records
+
+
+def read_events(path):
+    return read_records(path, MAGIC)
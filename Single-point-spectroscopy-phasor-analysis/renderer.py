@@ -0,0 +1,143 @@
+import time
+from collections import deque
+
+import numpy as np
+
+
+# points of the universal semicircle, (g - 0.5)^2 + s^2 = 0.25 with s >= 0
+def universal_semicircle(points=200):
+    theta = np.linspace(0, np.pi, points)
+    return 0.5 + 0.5 * np.cos(theta), 0.5 * np.sin(theta)
+
+
+# min and max of y over groups of consecutive samples, at most columns groups: the
+# decimated line draws the same envelope as the full one at that pixel width.
+# Both points keep the x and the order they have in the data, so the segments
+# joining neighbouring groups stay as short as in the full line.
+def decimate_minmax(x, y, columns):
+    n = len(y)
+    if n <= 2 * columns:
+        return x, y
+    group = -(-n // columns)
+    groups = -(-n // group)
+    padded = np.empty(groups * group)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    padded = padded.reshape(groups, group)
+    start = np.arange(groups) * group
+    low = start + padded.argmin(axis=1)
+    high = start + padded.argmax(axis=1)
+    index = np.column_stack((np.minimum(low, high), np.maximum(low, high))).ravel()
+    index = np.minimum(index, n - 1)
+    return x[index], y[index]
+
+
+class PhasorDensity:
+    """Phasor cloud kept as a 2D histogram over the g/s plane.
+
+    Points are binned as they arrive, so drawing the cloud as an image costs
+    the same for ten or a million points and dense regions stay readable.
+    Points outside extent (g_min, g_max, s_min, s_max) are only counted.
+    """
+
+    def __init__(self, extent=(-0.005, 1.2, 0, 0.6), shape=(120, 240)):
+        # shape: (rows along s, columns along g)
+        self.extent = extent
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.total = 0
+        self.outside = 0
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.outside = 0
+
+    def add(self, g, s):
+        g = np.atleast_1d(np.asarray(g, dtype=np.float64))
+        s = np.atleast_1d(np.asarray(s, dtype=np.float64))
+        g_min, g_max, s_min, s_max = self.extent
+        rows, columns = self.counts.shape
+        column = np.floor((g - g_min) / (g_max - g_min) * columns)
+        row = np.floor((s - s_min) / (s_max - s_min) * rows)
+        # NaN phasors of empty batches fail every comparison and are left out
+        inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        np.add.at(self.counts, (row[inside].astype(np.intp), column[inside].astype(np.intp)), 1)
+        self.total += len(g)
+        self.outside += len(g) - int(inside.sum())
+
+    # log-scaled counts for imshow(origin='lower'), empty cells masked to stay transparent
+    def image(self):
+        return np.ma.masked_where(self.counts == 0, np.log1p(self.counts))
+
+
+class CanvasRenderer:
+    """Redraws a FigureCanvas by updating persistent artists.
+
+    With blit=True the artists are animated: the static part of the figure
+    (axes, ticks, labels, semicircle) is rendered once and cached, and each
+    frame only restores that background, draws the artists and blits. Any
+    change to the static part must call invalidate() to trigger a full draw.
+    With blit=False each frame is a full canvas.draw(), useful as a fallback.
+    With a Metrics registry every draw is recorded as draw_<name>.
+    """
+
+    def __init__(self, canvas, blit=True, metrics=None, name='canvas'):
+        self.canvas = canvas
+        self.metrics = metrics
+        self.name = name
+        self.blit = blit
+        self.artists = []
+        self.background = None
+        self.frame_times = deque(maxlen=100)
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(self.blit)
+        self.artists.append(artist)
+        return artist
+
+    def invalidate(self):
+        self.background = None
+
+    # line data decimated to min/max per pixel column of its axes
+    def set_line_data(self, line, x, y):
+        columns = max(int(line.axes.bbox.width), 1)
+        line.set_data(*decimate_minmax(x, y, columns))
+
+    # grows the y range with some headroom and shrinks it back after a reset,
+    # so a full redraw is only needed a handful of times per acquisition
+    def autoscale_y(self, ax, values):
+        top = ax.get_ylim()[1]
+        peak = float(np.max(values)) if len(values) else 0.0
+        if peak > top or (top > 1 and peak < top / 4):
+            ax.set_ylim(0, max(peak * 1.5, 1))
+            self.invalidate()
+
+    def _on_draw(self, event):
+        if not self.blit:
+            return
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        figure = self.canvas.figure
+        for artist in self.artists:
+            figure.draw_artist(artist)
+
+    def update(self):
+        start = time.perf_counter()
+        if not self.blit or self.background is None:
+            # with blitting the draw_event handler caches the new background
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_artists()
+            self.canvas.blit(self.canvas.figure.bbox)
+        self.frame_times.append(time.perf_counter() - start)
+        if self.metrics is not None:
+            self.metrics.observe(f'draw_{self.name}', self.frame_times[-1])
+
+    def frame_time_ms(self, percentile=50):
+        if not self.frame_times:
+            return 0.0
+        return float(np.percentile(self.frame_times, percentile)) * 1000
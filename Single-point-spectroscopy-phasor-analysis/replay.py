@@ -0,0 +1,119 @@
+"""Offline re-analysis of raw photon event files written by EventRecorder.
+
+Recorded photons go through the same histogram folding (histogram_bins) and
+PhasorEngine used by the GUI, fully vectorized over memory-mapped chunks and
+without any Qt event loop, so parameters such as the bin offset, harmonic,
+calibration and batch length can be swept without touching the instrument.
+The photons of every channel listed in the metadata of the recording are
+folded into their own histogram row, as in the acquisition.
+
+    python replay.py data_events.bin --reference reference_events.bin --batch-seconds 1
+"""
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from ingestion import channel_rows, channel_table, histogram_bins
+from phasor_engine import PhasorEngine
+from recorder import read_events
+
+
+# channels: the acquired channels; histogram: global (channels, bins) histogram; batch_histograms:
+# (n_batches, channels, bins); batch_start: start of every batch in seconds of macro time; phasor
+# and batch_phasors: PhasorResult of the global histogram and of every batch, one value per channel
+ReplayResult = namedtuple('ReplayResult', ['channels', 'histogram', 'batch_histograms', 'batch_start', 'phasor',
+                                           'batch_phasors', 'engine', 'metadata'])
+
+
+# (n_batches, channels, bins) histograms of the events, batched on their macro time; as in
+# PhotonIngestor, a single channel takes every photon and otherwise unlisted channels are dropped
+def fold_events(events, bins, bin_offset, batch_seconds=None, chunk_events=1 << 22, channels=(1,)):
+    batch_ns = None if batch_seconds is None else batch_seconds * 1e9
+    n_channels = len(channels)
+    table = channel_table(channels)
+    n_batches = 1
+    if batch_ns is not None and len(events):
+        n_batches = int(events['macro_time'][-1] // batch_ns) + 1
+    histograms = np.zeros(n_batches * n_channels * bins, dtype=np.int64)
+    for start in range(0, len(events), chunk_events):
+        chunk = events[start:start + chunk_events]
+        index = histogram_bins(chunk['time_bin'].astype(np.int64), bins, bin_offset)
+        rows = 0
+        if n_channels > 1:
+            rows = channel_rows(chunk['channel'], table)
+            acquired = rows >= 0
+            chunk, index, rows = chunk[acquired], index[acquired], rows[acquired]
+        if batch_ns is not None:
+            batch = (chunk['macro_time'] // batch_ns).astype(np.int64)
+            rows = rows + np.minimum(batch, n_batches - 1) * n_channels
+        histograms += np.bincount(rows * bins + index, minlength=n_batches * n_channels * bins)
+    return histograms.reshape(n_batches, n_channels, bins)
+
+
+def replay(path, reference=None, bin_offset=None, harmonic=1, harmonics=2, tau_phase_reference=4,
+           tau_modulation_reference=4, batch_seconds=5, laser_mhz=None, chunk_events=1 << 22):
+    # reference: event file of the calibration sample, (channels, bins) reference histogram, or None
+    metadata, events = read_events(path)
+    bins = metadata['bins']
+    # recordings made before the channels were acquired apart hold a single one
+    channels = tuple(metadata.get('channels', (1,)))
+    bin_offset = metadata['bin_offset'] if bin_offset is None else bin_offset
+    laser_mhz = metadata['laser_mhz'] if laser_mhz is None else laser_mhz
+
+    engine = PhasorEngine(laser_mhz=laser_mhz, bins=bins, harmonic=harmonic, harmonics=harmonics,
+                          tau_phase_reference=tau_phase_reference,
+                          tau_modulation_reference=tau_modulation_reference)
+    if isinstance(reference, str):
+        reference_metadata, reference_events = read_events(reference)
+        if reference_metadata['bins'] != bins:
+            raise ValueError('Reference and data event files have a different number of bins')
+        if tuple(reference_metadata.get('channels', (1,))) != channels:
+            raise ValueError('Reference and data event files have different channels')
+        reference = fold_events(reference_events, bins, bin_offset, chunk_events=chunk_events,
+                                channels=channels)[0]
+    if reference is not None:
+        engine.calibrate(reference)
+
+    batch_histograms = fold_events(events, bins, bin_offset, batch_seconds, chunk_events, channels)
+    histogram = batch_histograms.sum(axis=0)
+    batch_start = np.arange(len(batch_histograms)) * batch_seconds
+    return ReplayResult(channels, histogram, batch_histograms, batch_start, engine.compute(histogram),
+                        engine.compute(batch_histograms), engine, metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-analyze a raw photon event file')
+    parser.add_argument('path', help='data event file')
+    parser.add_argument('--reference', help='reference event file used for the calibration')
+    parser.add_argument('--bin-offset', type=int, help='bin offset, defaults to the one of the recording')
+    parser.add_argument('--harmonic', type=int, default=1)
+    parser.add_argument('--tau-phase', type=float, default=4, help='reference tau_phase (ns)')
+    parser.add_argument('--tau-modulation', type=float, default=4, help='reference tau_modulation (ns)')
+    parser.add_argument('--batch-seconds', type=float, default=5)
+    parser.add_argument('--output', default='replay_batches.txt', help='text file of the batch phasors')
+    args = parser.parse_args()
+
+    result = replay(args.path, reference=args.reference, bin_offset=args.bin_offset, harmonic=args.harmonic,
+                    tau_phase_reference=args.tau_phase, tau_modulation_reference=args.tau_modulation,
+                    batch_seconds=args.batch_seconds)
+    phasor = result.phasor
+    print(f'{int(result.histogram.sum()):,} photons, {len(result.batch_histograms)} batches')
+    for channel, g, s, tau_phase, tau_modulation in zip(result.channels, phasor.g, phasor.s, phasor.tau_phase,
+                                                         phasor.tau_modulation):
+        print(f'channel {channel}: g = {g:.3f}  s = {s:.3f}  '
+              f'tau_phase = {tau_phase * 1e9:.3f} ns  tau_modulation = {tau_modulation * 1e9:.3f} ns')
+    # one row per batch and channel, like the phasor export of the GUI
+    batches = result.batch_phasors
+    n_batches, n_channels = batches.g.shape
+    columns = [np.repeat(result.batch_start, n_channels), result.batch_histograms.sum(axis=-1).ravel(),
+               batches.g.ravel(), batches.s.ravel(), batches.m.ravel(), batches.phi.ravel()]
+    header = 'start_s photons g s m phi'
+    if n_channels > 1:
+        columns.insert(0, np.tile(result.channels, n_batches))
+        header = 'channel ' + header
+    np.savetxt(args.output, np.column_stack(columns), header=header)
+
+
+if __name__ == '__main__':
+    main()
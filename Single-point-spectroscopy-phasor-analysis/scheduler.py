@@ -0,0 +1,77 @@
+import time
+
+from PyQt5.QtCore import QTimer
+
+
+class FrameScheduler:
+    """Single frame clock for the GUI.
+
+    Views register a render callback and are redrawn only when marked dirty
+    (new photons, parameter change, batch closed). Pollers are cheap checks
+    run on every tick that mark views dirty, e.g. by comparing the histogram
+    store sequence. At most max_fps frames per second are rendered and
+    nothing is rendered while the window is minimized or hidden; dirty flags
+    are kept until it is visible again.
+    With a Metrics registry the render time of every view, the frame time and
+    the skipped frames are recorded.
+    """
+
+    def __init__(self, window, max_fps=20, metrics=None):
+        self.window = window
+        self.metrics = metrics
+        self.views = {}
+        self.pollers = []
+        self.dirty = set()
+        self.frames = 0
+        self.skipped_frames = 0
+        self.last_frame_time = 0.0
+        self.timer = QTimer(window)
+        self.timer.timeout.connect(self.tick)
+        self.set_max_fps(max_fps)
+
+    def set_max_fps(self, max_fps):
+        self.max_fps = max_fps
+        self.timer.setInterval(int(1000 / max_fps))
+
+    def add_view(self, name, render):
+        self.views[name] = render
+        self.dirty.add(name)
+
+    def add_poller(self, poll):
+        self.pollers.append(poll)
+
+    # GUI thread only; with no names every view is marked
+    def mark_dirty(self, *names):
+        self.dirty.update(names or self.views)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def tick(self):
+        for poll in self.pollers:
+            poll()
+        if not self.dirty:
+            return
+        metrics = self.metrics
+        if self.window.isMinimized() or not self.window.isVisible():
+            self.skipped_frames += 1
+            if metrics is not None:
+                metrics.inc('skipped_frames')
+            return
+        start = time.perf_counter()
+        dirty, self.dirty = self.dirty, set()
+        for name, render in self.views.items():
+            if name in dirty:
+                if metrics is None:
+                    render()
+                else:
+                    with metrics.timer(f'render_{name}'):
+                        render()
+        self.frames += 1
+        self.last_frame_time = time.perf_counter() - start
+        if metrics is not None:
+            metrics.inc('frames')
+            metrics.observe('frame', self.last_frame_time)
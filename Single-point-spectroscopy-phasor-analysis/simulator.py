@@ -0,0 +1,125 @@
+import threading
+import time
+
+import numpy as np
+
+
+class SimulatedFlimLabsApi:
+    """Hardware-free stand-in for FlimLabsApi.
+
+    Exposes the same set_consumer_handler / set_firmware / acquire_spectroscopy /
+    acquire_measure_frequency / stop_acquisition surface and delivers photons
+    from a background thread through the consumer handler, one call per photon
+    like the real API. Decays are mono- or multi-exponential (taus in ns with
+    their amplitude fractions) convolved with a gaussian IRF, at a configurable
+    photon rate and laser frequency. The firmware bin offset is undone in the
+    generated time_bin, so the GUI bin offset puts the decay back in place.
+    monotonic_counter counts the laser periods since the start of the
+    acquisition, like the real API, or with counter_is_index numbers the
+    events one by one. With loss > 0 that fraction of the events is lost on
+    the way, which only leaves gaps in an event index.
+    """
+
+    def __init__(self, photon_rate=1_000_000, taus=(4.0,), amplitudes=None, irf_center=2.0, irf_fwhm=0.3,
+                 laser_mhz=None, channels=(1,), bins=256, bin_offset=90, slice_seconds=0.01, loss=0.0, counter_is_index=False,
+                 seed=None):
+        self.photon_rate = photon_rate
+        self.taus = np.asarray(taus, dtype=np.float64)
+        self.amplitudes = np.ones(len(self.taus)) if amplitudes is None else np.asarray(amplitudes, dtype=np.float64)
+        self.irf_center = irf_center
+        self.irf_fwhm = irf_fwhm
+        # laser frequency of the simulated source, defaults to the one requested by the acquisition
+        self.laser_mhz = laser_mhz
+        self.channels = np.asarray(channels)
+        self.bins = bins
+        self.bin_offset = bin_offset
+        self.slice_seconds = slice_seconds
+        self.loss = loss
+        self.counter_is_index = counter_is_index
+        self.rng = np.random.default_rng(seed)
+
+        self.consumer_handler = None
+        self.firmware = None
+        self.acquisition_time_seconds = None
+        self.photons_sent = 0
+        self.events_generated = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_consumer_handler(self, handler):
+        self.consumer_handler = handler
+
+    def set_firmware(self, firmware):
+        self.firmware = firmware
+
+    def acquire_spectroscopy(self, laser_frequency_mhz, acquisition_time_seconds):
+        if acquisition_time_seconds <= 0:
+            raise Exception("Acquisition time must be greater than 0 seconds")
+        self.acquisition_time_seconds = acquisition_time_seconds
+        laser_mhz = self.laser_mhz or laser_frequency_mhz
+        self._start(self._spectroscopy_task, laser_mhz)
+
+    def acquire_measure_frequency(self):
+        self._start(self._measure_frequency_task, self.laser_mhz or 40)
+
+    def stop_acquisition(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start(self, task, laser_mhz):
+        self.stop_acquisition()
+        self._stop.clear()
+        self._thread = threading.Thread(target=task, args=(laser_mhz,), daemon=True)
+        self._thread.start()
+
+    def _measure_frequency_task(self, laser_mhz):
+        if not self._stop.wait(0.5) and self.consumer_handler:
+            self.consumer_handler(float(laser_mhz))
+
+    # micro times (ns) of n photons: IRF jitter plus one of the exponential components
+    def generate_micro_times(self, n, laser_period_ns):
+        component = self.rng.choice(len(self.taus), size=n, p=self.amplitudes / self.amplitudes.sum())
+        sigma = self.irf_fwhm / (2 * np.sqrt(2 * np.log(2)))
+        micro_time = self.irf_center + self.rng.normal(0, sigma, n) + self.rng.exponential(self.taus[component])
+        return np.mod(micro_time, laser_period_ns)
+
+    def generate_events(self, start_ns, duration_ns, laser_mhz):
+        laser_period_ns = 1000 / laser_mhz
+        n = self.rng.poisson(self.photon_rate * duration_ns * 1e-9)
+        micro_time = self.generate_micro_times(n, laser_period_ns)
+        time_bin = (np.minimum((micro_time / laser_period_ns * self.bins).astype(np.int64), self.bins - 1)
+                    - self.bin_offset) % self.bins
+        macro_time = np.sort(self.rng.uniform(start_ns, start_ns + duration_ns, n))
+        if self.counter_is_index:
+            monotonic_counter = self.events_generated + np.arange(n)
+        else:
+            monotonic_counter = (macro_time / laser_period_ns).astype(np.int64)
+        self.events_generated += n
+        channel = self.rng.choice(self.channels, size=n)
+        events = channel, time_bin, micro_time, monotonic_counter, macro_time
+        if self.loss:
+            kept = self.rng.random(n) >= self.loss
+            events = tuple(values[kept] for values in events)
+        return events
+
+    def _spectroscopy_task(self, laser_mhz):
+        self.photons_sent = 0
+        self.events_generated = 0
+        slice_ns = self.slice_seconds * 1e9
+        end_ns = self.acquisition_time_seconds * 1e9
+        start = time.perf_counter()
+        t_ns = 0.0
+        while t_ns < end_ns and not self._stop.is_set():
+            events = self.generate_events(t_ns, min(slice_ns, end_ns - t_ns), laser_mhz)
+            handler = self.consumer_handler
+            if handler is not None:
+                for event in zip(*(values.tolist() for values in events)):
+                    handler(*event)
+            self.photons_sent += len(events[0])
+            t_ns += slice_ns
+            # pace the source to real time; a slow consumer simply falls behind
+            delay = start + t_ns * 1e-9 - time.perf_counter()
+            if delay > 0:
+                self._stop.wait(delay)
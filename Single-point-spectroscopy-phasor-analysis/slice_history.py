@@ -0,0 +1,161 @@
+import threading
+
+import numpy as np
+
+
+# length of the time slices the data acquisitions are kept in
+SLICE_SECONDS = 0.1
+
+
+# (slice index, (channels, bins) counts) of every slice of slice_ns touched by a chunk of increasing
+# macro times; counts is the histogram of the whole chunk, histogram(chunk, start, stop) the one of a part
+def slice_counts(chunk, counts, slice_ns, histogram):
+    macro_time = chunk['macro_time']
+    first = int(macro_time[0] // slice_ns)
+    last = int(macro_time[-1] // slice_ns)
+    if first == last:
+        return [(first, counts)]
+    bounds = [0, *np.searchsorted(macro_time, np.arange(first + 1, last + 1) * slice_ns), len(macro_time)]
+    return [(first + k, histogram(chunk, start, stop))
+            for k, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])) if stop > start]
+
+
+class SliceHistory:
+    """Prefix sums of the time-slice histograms of a data acquisition.
+
+    Row k of the (slices + 1, channels, bins) prefix array is the histogram
+    of the photons of the first k slices, so the histogram of the slices
+    a..b is row b - row a, in O(bins) whatever the window. Batch phasors of
+    any length, tumbling or sliding, are recomputed after the acquisition
+    without touching the photons. The phasor sums of the rows are computed
+    once per basis and extended as slices close, after which a window costs
+    O(harmonics).
+
+    Slices are slice_seconds of macro time from the start of the acquisition,
+    like the batches of MacroTimeBatcher. When the rows would take more than
+    max_bytes, every other row is dropped: the slices double in length and
+    memory stays bounded on long acquisitions. Photons are added by a single
+    thread; windows are read from any other.
+    """
+
+    def __init__(self, channels=1, bins=256, slice_seconds=SLICE_SECONDS, max_bytes=256 << 20):
+        self.channels = channels
+        self.base_ns = slice_seconds * 1e9
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.set_bins(bins)
+
+    def set_bins(self, bins):
+        self.bins = bins
+        self.max_rows = max(int(self.max_bytes // (self.channels * bins * 8)), 4)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._rows = np.zeros((64, self.channels, self.bins), dtype=np.int64)
+            # closed slices: rows 0..slices are valid, the open slice is accumulated apart
+            self.slices = 0
+            # slices are base_ns * 2 ** level long
+            self.level = 0
+            self._open = np.zeros((self.channels, self.bins), dtype=np.int64)
+        self._sums_key = None
+
+    @property
+    def slice_ns(self):
+        return self.base_ns * (1 << self.level)
+
+    # memory taken by the rows, grown by doubling up to max_bytes
+    @property
+    def nbytes(self):
+        return self._rows.nbytes
+
+    # counts of the slice `index` of base_ns, e.g. from slice_counts; the slices before it are closed
+    def add(self, index, counts):
+        index >>= self.level
+        if index > self.slices:
+            self._close(index)
+        self._open += counts
+
+    # closes the open slice, e.g. the partial last one of an acquisition
+    def flush(self):
+        if self._open.any():
+            self._close(self.slices + 1)
+
+    # closes the open slice and the empty ones up to index, which becomes the open one
+    def _close(self, index):
+        with self._lock:
+            while index >= self.max_rows:
+                self._coarsen()
+                index >>= 1
+            if index <= self.slices:
+                return
+            if index >= len(self._rows):
+                rows = np.empty((min(max(2 * len(self._rows), index + 1), self.max_rows), self.channels,
+                                 self.bins), dtype=np.int64)
+                rows[:self.slices + 1] = self._rows[:self.slices + 1]
+                self._rows = rows
+            # rows up to slices are never written again: readers use them without copies
+            self._rows[self.slices + 1] = self._rows[self.slices] + self._open
+            self._rows[self.slices + 2:index + 1] = self._rows[self.slices + 1]
+            self.slices = index
+            self._open = np.zeros_like(self._open)
+
+    # slices twice as long: row 2j of the old rows is row j of the new ones
+    def _coarsen(self):
+        if self.slices % 2:
+            # the last closed slice now shares its slice with the open one
+            self._open = self._open + self._rows[self.slices] - self._rows[self.slices - 1]
+            self.slices -= 1
+        rows = np.empty_like(self._rows)
+        kept = self._rows[:self.slices + 1:2]
+        rows[:len(kept)] = kept
+        self._rows = rows
+        self.slices //= 2
+        self.level += 1
+
+    def _read(self):
+        with self._lock:
+            return self._rows, self.slices, self.level
+
+    # first and last slice of every window of window_seconds, every step_seconds; without step the
+    # windows are tumbling and the last one may be shorter, like the last batch of an acquisition.
+    # Sliding windows longer than the acquisition give a single shorter window over all of it
+    def window_bounds(self, window_seconds, step_seconds=None, slices=None, slice_ns=None):
+        if slices is None:
+            slices, slice_ns = self.slices, self.slice_ns
+        width = max(int(round(window_seconds * 1e9 / slice_ns)), 1)
+        if step_seconds is None:
+            starts = np.arange(0, slices, width)
+        else:
+            step = max(int(round(step_seconds * 1e9 / slice_ns)), 1)
+            starts = np.arange(0, max(slices - width + 1, min(slices, 1)), step)
+        return starts, np.minimum(starts + width, slices)
+
+    # (windows, channels, bins) histograms of the windows
+    def window_histograms(self, window_seconds, step_seconds=None):
+        rows, slices, level = self._read()
+        starts, ends = self.window_bounds(window_seconds, step_seconds, slices, self.base_ns * (1 << level))
+        return rows[ends] - rows[starts]
+
+    # start and end (ns) of the windows, their (windows, channels, 2H) phasor sums in basis and
+    # (windows, channels) photon totals, as taken by PhasorEngine.compute_harmonics_from_sums
+    def window_sums(self, basis, window_seconds, step_seconds=None):
+        rows, slices, level = self._read()
+        slice_ns = self.base_ns * (1 << level)
+        sums, totals = self._prefix_sums(basis, rows, slices, level)
+        starts, ends = self.window_bounds(window_seconds, step_seconds, slices, slice_ns)
+        return starts * slice_ns, ends * slice_ns, sums[ends] - sums[starts], totals[ends] - totals[starts]
+
+    # phasor sums and totals of the rows 0..slices, extended from the last call when the basis
+    # and slice length did not change
+    def _prefix_sums(self, basis, rows, slices, level):
+        key = self._sums_key
+        if key is None or key[0] is not basis or key[1] != level or key[2] > slices:
+            sums, totals, done = np.empty((0, self.channels, basis.shape[0])), np.empty((0, self.channels)), 0
+        else:
+            sums, totals, done = self._sums, self._totals, key[2] + 1
+        new = rows[done:slices + 1].astype(np.float64)
+        self._sums = np.concatenate((sums[:done], new @ basis.T))
+        self._totals = np.concatenate((totals[:done], new.sum(axis=-1)))
+        self._sums_key = (basis, level, slices)
+        return self._sums, self._totals
@@ -0,0 +1,36 @@
+import numpy as np
+
+from calibration_cache import CalibrationCache
+from headless import HeadlessAcquisition
+
+
+def test_reference_stored_by_the_gui_is_found_by_headless(tmp_path):
+    path = str(tmp_path / 'calibration_cache.json')
+    reference = np.arange(256, dtype=np.float64)[None]
+    # the GUI keys its settings with ints: laser 40 MHz, reference lifetimes 4 ns
+    CalibrationCache(path).store(CalibrationCache.key(40, 1, 256, 90, 4, 4, (1,)), reference)
+    session = HeadlessAcquisition(laser_mhz=40.0, tau_phase_reference=4.0, tau_modulation_reference=4.0,
+                                  simulate=True, calibrations=path)
+    try:
+        assert session.calibration_key() in session.calibrations.entries
+        assert session.restore_calibration()
+        np.testing.assert_array_equal(session.reference, reference)
+    finally:
+        session.close()
+
+
+def test_find_prefers_the_exact_entry_over_the_latest_of_the_layout(tmp_path):
+    cache = CalibrationCache(str(tmp_path / 'calibration_cache.json'))
+    exact = np.full((1, 256), 1.0)
+    cache.store(CalibrationCache.key(40, 2, 256, 90, 4, 4), exact)
+    cache.entries[CalibrationCache.key(40, 2, 256, 90, 4, 4)]['time'] = '2000-01-01T00:00:00'
+    cache.store(CalibrationCache.key(40, 1, 256, 90, 4, 4), np.full((1, 256), 2.0))
+    np.testing.assert_array_equal(cache.find(CalibrationCache.key(40.0, 2.0, 256, 90, 4.0, 4.0)), exact)
+
+
+def test_keys_of_older_files_are_normalized(tmp_path):
+    path = tmp_path / 'calibration_cache.json'
+    path.write_text('{"[40, 1, 256, 90, 4, 4, [1]]": {"time": "2024-01-01T00:00:00", "reference": [[1, 2]], '
+                    '"phi_instr": [[0.1]], "m_instr": [[0.9]]}}')
+    cache = CalibrationCache(str(path))
+    np.testing.assert_array_equal(cache.find(CalibrationCache.key(40.0, 1, 256, 90, 4.0, 4.0)), [[1, 2]])
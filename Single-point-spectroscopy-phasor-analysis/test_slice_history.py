@@ -0,0 +1,47 @@
+import numpy as np
+
+from slice_history import SliceHistory
+
+
+def acquisition(slices, channels=1, bins=8):
+    history = SliceHistory(channels, bins, slice_seconds=0.1)
+    counts = np.arange(1, slices + 1)[:, None, None] * np.ones((channels, bins), dtype=np.int64)
+    for index, count in enumerate(counts):
+        history.add(index, count)
+    history.flush()
+    return history, counts
+
+
+def test_tumbling_windows_end_with_a_partial_one():
+    history, counts = acquisition(5)
+    starts, ends = history.window_bounds(0.2)
+    assert starts.tolist() == [0, 2, 4]
+    assert ends.tolist() == [2, 4, 5]
+    np.testing.assert_array_equal(history.window_histograms(0.2)[-1], counts[4])
+
+
+def test_sliding_windows():
+    history, counts = acquisition(5)
+    starts, ends = history.window_bounds(0.3, 0.1)
+    assert starts.tolist() == [0, 1, 2]
+    assert ends.tolist() == [3, 4, 5]
+    np.testing.assert_array_equal(history.window_histograms(0.3, 0.1)[1], counts[1:4].sum(axis=0))
+
+
+def test_sliding_window_longer_than_the_acquisition():
+    history, counts = acquisition(3)
+    starts, ends = history.window_bounds(1.0, 0.1)
+    assert starts.tolist() == [0]
+    assert ends.tolist() == [3]
+    np.testing.assert_array_equal(history.window_histograms(1.0, 0.1), counts.sum(axis=0)[None])
+    basis = np.ones((2, 8))
+    window_starts, window_ends, sums, totals = history.window_sums(basis, 1.0, 0.1)
+    assert window_ends.tolist() == [3 * history.slice_ns]
+    assert totals.tolist() == [[counts.sum()]]
+
+
+def test_no_window_before_any_slice():
+    history = SliceHistory(1, 8)
+    for step in (None, 0.1):
+        starts, ends = history.window_bounds(1.0, step)
+        assert len(starts) == len(ends) == 0